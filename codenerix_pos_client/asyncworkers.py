@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-pos-client
+#
+# Copyright 2017 Juanmi Taboada - http://www.juanmitaboada.com
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import asyncio
+import functools
+import threading
+import concurrent.futures
+
+from lib.debugger import Debugger
+
+from workers import POSWorker, POSWorkerConfigError, POSQueueFull
+
+
+class AsyncRuntime(threading.Thread, Debugger):
+    '''
+    Single thread running an asyncio loop where every AsyncPOSWorker lives as
+    a task, blocking calls are sent to a small pool of threads
+    '''
+
+    executor_workers = 2
+
+    def __init__(self):
+        # Prepare debugger
+        self.set_name("AsyncRuntime")
+        self.set_debug()
+
+        # Prepare threading system
+        super(AsyncRuntime, self).__init__(daemon=True)
+
+        # Prepare the loop and the executor for blocking drivers
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.executor_workers)
+
+    def run(self):
+        self.debug("Starting asyncio runtime", color='blue')
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+        self.debug("Asyncio runtime is down", color='green')
+
+    def spawn(self, worker):
+        # Start the worker as a task in our loop
+        return asyncio.run_coroutine_threadsafe(worker.bootstrap(self), self.loop)
+
+    def stop(self, timeout=None):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        super(AsyncRuntime, self).join(timeout)
+        self.executor.shutdown(wait=False)
+
+
+class AsyncPOSWorker(POSWorker):
+    '''
+    POSWorker running as a task inside an AsyncRuntime instead of having its
+    own thread: run(), loop() and recv() are coroutines and get()/send() are
+    awaitable. Use blocking() for drivers that would block the loop.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # Normal initialization
+        super(AsyncPOSWorker, self).__init__(*args, **kwargs)
+
+        # Runtime details (set by bootstrap)
+        self.__runtime = None
+        self.__future = None
+        self.__event = None
+
+    def start(self):
+        raise POSWorkerConfigError("{} must be spawned in an AsyncRuntime, it can not be started as a thread".format(self.uuidhex))
+
+    def isAlive(self):
+        return self.__future is not None and not self.__future.done()
+
+    def is_alive(self):
+        return self.isAlive()
+
+    def crashed(self):
+        return self.__future is not None and self.__future.done() and not self.stoprequest.isSet()
+
+    def spawn(self, runtime):
+        self.__future = runtime.spawn(self)
+        return self.__future
+
+    async def bootstrap(self, runtime):
+        self.__runtime = runtime
+        self.__event = asyncio.Event()
+
+        # Wake us up when our queue gets something
+        loop = asyncio.get_running_loop()
+        self.mailbox.notify = lambda: loop.call_soon_threadsafe(self.__event.set)
+
+        try:
+            await self.run()
+        finally:
+            self.mailbox.notify = None
+
+    async def blocking(self, f, *args, **kwargs):
+        # Run a blocking call in the runtime executor and wait for it
+        return await asyncio.get_running_loop().run_in_executor(self.__runtime.executor, functools.partial(f, *args, **kwargs))
+
+    async def get_many(self, max_items=None, timeout=None):
+
+        # Take whatever is waiting
+        packages = list(super(AsyncPOSWorker, self).get_many(max_items))
+        if not packages and not self.awake:
+            # Nothing yet, make sure nothing arrived before we start waiting
+            self.__event.clear()
+            packages = list(super(AsyncPOSWorker, self).get_many(max_items))
+            if not packages and not self.awake and timeout:
+                try:
+                    await asyncio.wait_for(self.__event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    packages = list(super(AsyncPOSWorker, self).get_many(max_items))
+
+        return packages
+
+    async def pause(self, seconds):
+        # Sleep without holding the loop, wake up at once if we are asked to stop
+        deadline = time.monotonic() + seconds
+        while not self.stoprequest.isSet():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.__event.clear()
+            if self.stoprequest.isSet():
+                break
+            try:
+                await asyncio.wait_for(self.__event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def get(self, timeout=None):
+        packages = await self.get_many(1, timeout)
+        if packages:
+            return packages[0]
+        else:
+            return None
+
+    async def send(self, msg, ref, target=None, priority=None):
+        try:
+            super(AsyncPOSWorker, self).send(msg, ref, target, priority, False)
+        except POSQueueFull:
+            # Target is full, wait for room out of the loop (it will fail again if the target rejects)
+            await self.blocking(super(AsyncPOSWorker, self).send, msg, ref, target, priority)
+
+    async def loop(self):
+        pass
+
+    async def run(self):
+        if self.module_name:
+            self.debug("Starting {}".format(self.module_name), color='blue')
+
+        # Time between loops and when the next one should happen
+        tick = self.config('tick', self.loop_tick)
+        next_loop = time.monotonic()
+
+        # Keep running until master say to stop
+        while not self.stoprequest.isSet():
+
+            # Wait for messages until next loop is due
+            packages = await self.get_many(self.batch_size, max(0, next_loop - time.monotonic()))
+            for (source, msg, ref) in packages:
+                try:
+                    await self.recv(msg, ref, source)
+                except Exception as e:
+                    try:
+                        await self.send({'uuid': self.uuidhex, 'from': self.get_uuid(source), 'msg': msg, 'error': str(e)}, ref)
+                    except Exception as e:
+                        self.error("Error answer couldn't be delivered: {}".format(e))
+
+            if not packages and (self.woken() or time.monotonic() >= next_loop):
+                # Do a loop and schedule the next one
+                try:
+                    await self.loop()
+                except POSQueueFull as e:
+                    self.warning("Message from loop couldn't be delivered: {}".format(e))
+                next_loop = time.monotonic() + tick
+
+    async def recv(self, msg, ref, uid=None):
+        if uid is not None and 'ping' in msg:
+            await self.send("pong", ref, uid, 'control')
+        else:
+            await self.send({'error': "Unknown msg kind"}, ref, uid)
+
+    def join(self, timeout=None):
+        self.stop()
+        if self.__future is not None:
+            concurrent.futures.wait([self.__future], timeout)
+
+
+if __name__ == '__main__':
+    # Memory and wakeups of idle devices: one thread each against one task each in a single runtime
+    import sys
+    import uuid
+    import resource
+    import subprocess
+
+    devices = 200
+    seconds = 10
+
+    def rss():
+        # Resident memory of the process in KiB
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+
+    if len(sys.argv) < 2:
+        # Measure every mode in a fresh interpreter so they do not share memory
+        for mode in ('thread', 'async'):
+            subprocess.run((sys.executable, sys.argv[0], mode))
+        sys.exit(0)
+
+    for mode in sys.argv[1:]:
+        memory = rss()
+        switches = resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw
+        runtime = None
+        if mode == 'thread':
+            workers = [POSWorker(uuid.uuid4(), {}) for i in range(devices)]
+            for worker in workers:
+                worker.start()
+        else:
+            runtime = AsyncRuntime()
+            runtime.start()
+            workers = [AsyncPOSWorker(uuid.uuid4(), {}) for i in range(devices)]
+            for worker in workers:
+                worker.spawn(runtime)
+
+        time.sleep(seconds)
+        memory = rss() - memory
+        switches = resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw - switches
+        threads = threading.active_count()
+
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+        if runtime is not None:
+            runtime.stop()
+
+        print("{:>6}: {} devices - {} threads - {} KiB more memory - {:.0f} wakeups/sec".format(mode, devices, threads, memory, switches / seconds))
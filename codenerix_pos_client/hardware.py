@@ -20,31 +20,59 @@
 
 import re
 import io
-import serial
 import base64
-from usb.core import USBError
-from usb1 import USBErrorBusy
-from escpos.printer import Usb, Network, USBNotFoundError
-
-# Smartcard libraries
-try:
-    from smartcard.CardMonitoring import CardMonitor
-    CardMonitorError = None
-except Exception as e:
-    CardMonitor = None
-    CardMonitorError = str(e)
-# from smartcard.CardType import AnyCardType
-# from smartcard.CardRequest import CardRequest
-# from smartcard.util import *
+import threading
 
 from lib.debugger import Debugger
 
 from workers import POSWorker
 
-if CardMonitor:
-    from dnie import DNIeObserver
-else:
-    DNIeObserver = None
+# Drivers are loaded the first time a device needs them, so a till only pays for the hardware it has
+serial = None
+Usb = Network = USBNotFoundError = USBError = USBErrorBusy = None
+CardMonitor = None
+CardMonitorError = "Smartcard library not loaded"
+DNIeObserver = None
+__drivers_lock = threading.Lock()
+
+
+def load_serial():
+    global serial
+    with __drivers_lock:
+        if serial is None:
+            try:
+                import serial
+            except ImportError as e:
+                raise HardwareError("Serial driver is not installed: {}".format(e))
+
+
+def load_escpos():
+    global Usb, Network, USBNotFoundError, USBError, USBErrorBusy
+    with __drivers_lock:
+        if Usb is None:
+            try:
+                from usb.core import USBError
+                from usb1 import USBErrorBusy
+                from escpos.printer import Usb, Network, USBNotFoundError
+            except ImportError as e:
+                raise HardwareError("Printer driver is not installed: {}".format(e))
+
+
+def load_smartcard():
+    global CardMonitor, CardMonitorError, DNIeObserver
+    with __drivers_lock:
+        if CardMonitor is None:
+            # Smartcard libraries
+            try:
+                from smartcard.CardMonitoring import CardMonitor
+                from dnie import DNIeObserver
+                CardMonitorError = None
+            except Exception as e:
+                CardMonitor = None
+                CardMonitorError = str(e)
+            # from smartcard.CardType import AnyCardType
+            # from smartcard.CardRequest import CardRequest
+            # from smartcard.util import *
 
 
 class POSWeightSerial(Debugger):
@@ -59,6 +87,9 @@ class POSWeightSerial(Debugger):
         self.set_name('POSWeightSerial')
         self.set_debug()
 
+        # Load driver
+        load_serial()
+
         # Get basic configuration
         if config is None:
             config = []
@@ -147,6 +178,8 @@ class POSWeightSerial(Debugger):
 
 class POSWeight(POSWorker):
     module_name = "Weight System"
+    queue_policy = 'latest'     # Only the newest request is served, older ones are answered with an error
+    durable = False             # Readings are streamed, an old one is worthless after a reconnection
 
     def __init__(self, *args, **kwargs):
         # Normal initialization
@@ -189,6 +222,9 @@ class POSWeight(POSWorker):
                 answer = {'weight': number, 'unit': unit}
                 self.__last_value = answer
                 self.send(answer, None)
+
+                # Let local subscribers know about it too
+                self.publish("weight.{}".format(self.uuidhex), answer)
             except Exception as e:
                 try:
                     self.error("I got a wrong data from the bus: {}".format(e))
@@ -202,6 +238,9 @@ class POSWeight(POSWorker):
 
 class POSTicketPrinter(POSWorker):
     module_name = "Ticket Printer"
+    queue_size = 20
+    queue_policy = 'reject'
+    priority = 'bulk'
 
     __EURO = '€'
     __CODE_EURO = "\x1b\x74\x13"  # chr(19)
@@ -210,6 +249,9 @@ class POSTicketPrinter(POSWorker):
     __CODE_NORMAL_CP = 'cp852'
 
     def __init__(self, *args, **kwargs):
+        # Load driver
+        load_escpos()
+
         # Normal initialization
         super(POSTicketPrinter, self).__init__(*args, **kwargs)
 
@@ -380,6 +422,7 @@ class POSTicketPrinter(POSWorker):
 
 class POSCashDrawer(POSTicketPrinter):
     module_name = "Cash Drawer"
+    priority = 'control'
 
     def actions(self, data, printer):
         self.debug('Open Cash Drawer', color='white')
@@ -389,6 +432,9 @@ class POSCashDrawer(POSTicketPrinter):
 class POSDNIe(POSWorker):
 
     def __init__(self, *args, **kwargs):
+        # Load driver
+        load_smartcard()
+
         super(POSDNIe, self).__init__(*args, **kwargs)
 
     @property
@@ -431,6 +477,9 @@ class POSDNIe(POSWorker):
             # Send final package
             posworker.send(package, None)
 
+            # Let local subscribers know about it too
+            posworker.publish("dnie.{}".format(posworker.uuidhex), package)
+
         # End of wrapper
         return lambda struct: got_internal_cid(self, struct)
 
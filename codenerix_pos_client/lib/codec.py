@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-pos-client
+#
+# Copyright 2017 Juanmi Taboada - http://www.juanmitaboada.com
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+JSON codec used all over the client. It works with the fastest library
+available (orjson, ujson or the standard json module) and it can be chosen
+with select(). dumps() always returns a string and loads() accepts strings or
+bytes and raises ValueError when the data is not valid JSON.
+'''
+
+import json
+
+__all__ = ["CODECS", "select", "selected", "dumps", "loads"]
+
+
+class JSONCodec(object):
+    '''
+    Standard json module
+    '''
+
+    name = 'json'
+
+    def dumps(self, obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class ORJSONCodec(JSONCodec):
+    '''
+    orjson: returns bytes and doesn't know some types (big integers), those
+    cases go to the standard module
+    '''
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def dumps(self, obj, sort_keys=False):
+        try:
+            if sort_keys:
+                return self.orjson.dumps(obj, option=self.orjson.OPT_SORT_KEYS).decode('utf-8')
+            else:
+                return self.orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            return super(ORJSONCodec, self).dumps(obj, sort_keys)
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+class UJSONCodec(JSONCodec):
+    '''
+    ujson
+    '''
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, obj, sort_keys=False):
+        try:
+            return self.ujson.dumps(obj, sort_keys=sort_keys, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return super(UJSONCodec, self).dumps(obj, sort_keys)
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+
+# Codecs in order of preference
+CODECS = [ORJSONCodec, UJSONCodec, JSONCodec]
+
+_codec = JSONCodec()
+
+
+def select(name=None):
+    '''
+    Choose the codec by name, None or 'auto' picks the fastest one installed
+    '''
+    global _codec
+    for codec in CODECS:
+        if name in (None, 'auto', codec.name):
+            try:
+                _codec = codec()
+            except ImportError:
+                if name == codec.name:
+                    raise
+            else:
+                break
+    else:
+        raise ValueError("Unknown JSON codec '{}'".format(name))
+    return _codec.name
+
+
+def selected():
+    return _codec.name
+
+
+def dumps(obj, sort_keys=False):
+    return _codec.dumps(obj, sort_keys)
+
+
+def loads(data):
+    return _codec.loads(data)
+
+
+# Start with the fastest one
+select()
+
+
+if __name__ == '__main__':
+    # Check all codecs read and write the same and compare their speed on a ticket
+    import time
+    import base64
+
+    ticket = {
+        'request': {
+            'action': 'msg',
+            'uuid': "0f1e2d3c4b5a69788796a5b4c3d2e1f0",
+            'msg': {
+                'ctx': {
+                    'logo': base64.b64encode(bytes(range(256)) * 64).decode('utf-8'),
+                    'company': "Compañía Ejemplo S.L. / Tienda 3",
+                    'lines': [{'product': "Café con leche {}".format(i), 'quantity': i % 3 + 1, 'price': 1.35 * i, 'tax': 21, 'discount': None, 'gift': i % 7 == 0} for i in range(40)],
+                    'total': 1234.56,
+                },
+                'template': 'ticket',
+            },
+        },
+        'ref': "2017-11-29 10:00:00.000000",
+    }
+    reference = json.loads(json.dumps(ticket))
+
+    rounds = 500
+    for codec in CODECS:
+        try:
+            select(codec.name)
+        except ImportError:
+            print("{:>6}: not installed".format(codec.name))
+            continue
+        encoded = dumps(ticket)
+        assert loads(encoded) == reference, "{} doesn't decode the same".format(codec.name)
+        assert loads(encoded.encode('utf-8')) == reference, "{} doesn't decode bytes the same".format(codec.name)
+        assert json.loads(encoded) == reference, "{} doesn't encode the same".format(codec.name)
+        sortedkeys = dumps({'b': 1, 'a': 2}, sort_keys=True)
+        assert sortedkeys.index('"a"') < sortedkeys.index('"b"'), "{} doesn't sort keys".format(codec.name)
+        start = time.perf_counter()
+        for i in range(rounds):
+            dumps(ticket)
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(rounds):
+            loads(encoded)
+        decode = time.perf_counter() - start
+        print("{:>6}: {} bytes - dumps {:8.1f} us - loads {:8.1f} us".format(codec.name, len(encoded), encode / rounds * 1e6, decode / rounds * 1e6))
@@ -26,45 +26,195 @@
 # raw string is decoded from Base64, the first 16 bytes are taken as the IV and the rest as
 # the encrypted string, the key is hashed with SHA256 and then the encrypted string is decrypted
 # using the IV and the hashed key.
+#
+# Binary transport uses AES-GCM with the same hashed KEY: the output is NONCE+ENCRYPTED+TAG with
+# no Base64, and any header sent in clear next to it can be authenticated as associated data.
 
 
 import base64
 import hashlib
+import threading
 
 from Cryptodome import Random
 from Cryptodome.Cipher import AES
 
+# AES-GCM from OpenSSL if the 'cryptography' package is installed, its ciphers keep the
+# key schedule so they are built once per key (Cryptodome builds everything on every frame)
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+
+
+class IVSource(object):
+    """
+    Random bytes read from the system in big chunks and served in small pieces
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__buffer = b''
+        self.__pos = 0
+
+    def read(self, length):
+        with self.__lock:
+            if self.__pos + length > len(self.__buffer):
+                self.__buffer = Random.get_random_bytes(max(self.size, length))
+                self.__pos = 0
+            data = self.__buffer[self.__pos:self.__pos + length]
+            self.__pos += length
+        return data
+
 
 class AESCipher(object):
     """
     Adapted solution from: https://stackoverflow.com/a/21928790/1481040
     """
 
-    def __init__(self):
+    # Shared by all ciphers
+    ivsource = IVSource()
+
+    # AES-GCM sizes
+    nonce_size = 12
+    tag_size = 16
+
+    def __init__(self, openssl=True):
+        '''
+        openssl: use OpenSSL for AES-GCM when it is available
+        '''
         self.bs = 32
+        self.__hashkeys = {}
+        self.__gcms = {}
+        self.openssl = openssl and AESGCM is not None
+
+    def hashkey(self, key):
+        # SHA256 of the key is computed once per key
+        hashkey = self.__hashkeys.get(key, None)
+        if hashkey is None:
+            hashkey = hashlib.sha256(key.encode()).digest()
+            self.__hashkeys[key] = hashkey
+        return hashkey
 
     def encrypt(self, raw, key, iv=None, b64encoded=True):
+        '''
+        raw: text or bytes
+        '''
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
         raw = self._pad(raw)
         if iv is None:
-            iv = Random.new().read(AES.block_size)
-        hashkey = hashlib.sha256(key.encode()).digest()
-        cipher = AES.new(hashkey, AES.MODE_CBC, iv)
+            iv = self.ivsource.read(AES.block_size)
+        cipher = AES.new(self.hashkey(key), AES.MODE_CBC, iv)
         if (b64encoded):
-            return base64.b64encode(iv + cipher.encrypt(raw.encode()))
+            return base64.b64encode(iv + cipher.encrypt(raw))
         else:
-            return iv + cipher.encrypt(raw.encode())
+            return iv + cipher.encrypt(raw)
 
-    def decrypt(self, enc, key, b64encoded=True):
+    def decrypt(self, enc, key, b64encoded=True, text=True):
+        '''
+        text: decode the result as UTF-8, otherwise bytes are returned
+        '''
         if b64encoded:
             enc = base64.b64decode(enc)
         iv = enc[:AES.block_size]
-        hashkey = hashlib.sha256(key.encode()).digest()
-        cipher = AES.new(hashkey, AES.MODE_CBC, iv)
-        return self._unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
+        cipher = AES.new(self.hashkey(key), AES.MODE_CBC, iv)
+        raw = self._unpad(cipher.decrypt(enc[AES.block_size:]))
+        if text:
+            return raw.decode('utf-8')
+        else:
+            return raw
+
+    def gcm(self, key):
+        # OpenSSL AES-GCM cipher for the key (built once)
+        gcm = self.__gcms.get(key, None)
+        if gcm is None:
+            gcm = AESGCM(self.hashkey(key))
+            self.__gcms[key] = gcm
+        return gcm
+
+    def encrypt_gcm(self, raw, key, header=b''):
+        nonce = self.ivsource.read(self.nonce_size)
+        if self.openssl:
+            # Same output: NONCE+ENCRYPTED+TAG
+            return nonce + self.gcm(key).encrypt(nonce, raw, header or None)
+        cipher = AES.new(self.hashkey(key), AES.MODE_GCM, nonce=nonce, mac_len=self.tag_size)
+        cipher.update(header)
+        (enc, tag) = cipher.encrypt_and_digest(raw)
+        return nonce + enc + tag
+
+    def decrypt_gcm(self, enc, key, header=b''):
+        '''
+        Raise ValueError if the data or the header have been tampered with
+        '''
+        if len(enc) < self.nonce_size + self.tag_size:
+            raise ValueError("Frame is too short")
+        nonce = enc[:self.nonce_size]
+        if self.openssl:
+            try:
+                return self.gcm(key).decrypt(nonce, enc[self.nonce_size:], header or None)
+            except InvalidTag:
+                raise ValueError("MAC check failed")
+        cipher = AES.new(self.hashkey(key), AES.MODE_GCM, nonce=nonce, mac_len=self.tag_size)
+        cipher.update(header)
+        return cipher.decrypt_and_verify(enc[self.nonce_size:-self.tag_size], enc[-self.tag_size:])
 
     def _pad(self, s):
-        return s + (self.bs - len(s) % self.bs) * chr(self.bs - len(s) % self.bs)
+        # Padding is counted on bytes (counting characters breaks non-ASCII text)
+        return s + (self.bs - len(s) % self.bs) * bytes([self.bs - len(s) % self.bs])
 
     @staticmethod
     def _unpad(s):
         return s[:-ord(s[len(s) - 1:])]
+
+
+if __name__ == '__main__':
+    # Throughput, CPU per message and bytes on the wire for CBC+Base64+JSON and GCM binary frames
+    # (run it as "python3 -m lib.cryptography", run as a script this file hides the 'cryptography' package)
+    import json
+    import time
+
+    crypto = AESCipher()
+    gcms = [('GCM', AESCipher(openssl=False))]
+    if crypto.openssl:
+        gcms.append(('GCM/OpenSSL', crypto))
+    key = "benchmark"
+    header = b"\x01" + b"u" * 16
+    for size in (100, 1000, 10000, 100000, 1000000):
+        raw = "x" * size
+        rounds = max(5, 2000000 // size)
+
+        # CBC (as POSClient sends it: encrypted, Base64 and wrapped in JSON)
+        start = time.perf_counter()
+        for i in range(rounds):
+            enc = crypto.encrypt(raw, key)
+            wire = json.dumps({'uuid': "u" * 32, 'message': enc.decode('utf-8')})
+        encrypt = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(rounds):
+            crypto.decrypt(json.loads(wire)['message'], key)
+        decrypt = time.perf_counter() - start
+        print("{:>8} bytes CBC: {:>8} on wire - encrypt {:8.1f} MB/s ({:8.1f} us/msg) - decrypt {:8.1f} MB/s ({:8.1f} us/msg)".format(
+            size, len(wire),
+            size * rounds / encrypt / 1e6, encrypt / rounds * 1e6,
+            size * rounds / decrypt / 1e6, decrypt / rounds * 1e6,
+        ))
+
+        # GCM binary frame (both implementations must read each other)
+        for (name, gcm) in gcms:
+            start = time.perf_counter()
+            for i in range(rounds):
+                wire = header + gcm.encrypt_gcm(raw.encode('utf-8'), key, header)
+            encrypt = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(rounds):
+                gcm.decrypt_gcm(wire[len(header):], key, header)
+            decrypt = time.perf_counter() - start
+            for (other, check) in gcms:
+                assert check.decrypt_gcm(wire[len(header):], key, header) == raw.encode('utf-8'), "{} can't read {}".format(other, name)
+            print("{:>8} bytes {}: {:>8} on wire - encrypt {:8.1f} MB/s ({:8.1f} us/msg) - decrypt {:8.1f} MB/s ({:8.1f} us/msg)".format(
+                size, name, len(wire),
+                size * rounds / encrypt / 1e6, encrypt / rounds * 1e6,
+                size * rounds / decrypt / 1e6, decrypt / rounds * 1e6,
+            ))
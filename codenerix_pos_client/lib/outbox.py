@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-pos-client
+#
+# Copyright 2017 Juanmi Taboada - http://www.juanmitaboada.com
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Crash safe outbox stored in SQLite (WAL journal). Messages are appended before
+they are sent and removed once they went out, so whatever was left when the
+connection or the program died can be sent again in the same order. The same
+message appended twice under the same ref is stored only once. Refs are stored
+as JSON so they come back as they went in.
+'''
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+__all__ = ["Outbox"]
+
+
+class Outbox(object):
+
+    def __init__(self, path, max_messages=10000, max_age=7 * 86400):
+        '''
+        max_messages: oldest messages are dropped when there are more than these
+        max_age: seconds a message is kept before it is dropped
+        '''
+        self.path = path
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.__lock = threading.Lock()
+
+        # With WAL and synchronous=NORMAL commits survive a crash of the program
+        # and the disk is only synced on checkpoints (a power cut may lose the last ones)
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, ref TEXT, digest TEXT NOT NULL, created REAL NOT NULL, payload TEXT NOT NULL, UNIQUE (ref, digest))")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS outbox_created ON outbox (created)")
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def put(self, payload, ref=None):
+        '''
+        Append a message (text), return False if it was already waiting
+        '''
+        digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        if ref is not None:
+            ref = json.dumps(ref, sort_keys=True)
+        with self.__lock:
+            cursor = self.__db.execute("INSERT OR IGNORE INTO outbox (ref, digest, created, payload) VALUES (?, ?, ?, ?)", (ref, digest, time.time(), payload))
+            # Limits hold while nobody is reading (we may be disconnected for long)
+            self.__prune()
+            return cursor.rowcount > 0
+
+    @staticmethod
+    def decode_ref(ref):
+        if ref is not None:
+            try:
+                ref = json.loads(ref)
+            except ValueError:
+                # Written before refs were stored as JSON
+                pass
+        return ref
+
+    def pending(self, limit=100):
+        '''
+        Oldest messages waiting as a list of (id, payload, ref)
+        '''
+        with self.__lock:
+            self.__prune()
+            rows = self.__db.execute("SELECT id, payload, ref FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(i, payload, self.decode_ref(ref)) for (i, payload, ref) in rows]
+
+    def done(self, ids):
+        # Forget messages that went out
+        with self.__lock:
+            self.__db.execute("BEGIN")
+            self.__db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+            self.__db.execute("COMMIT")
+
+    def prune(self):
+        '''
+        Drop too old messages and the oldest ones above the limit, return how many were dropped
+        '''
+        with self.__lock:
+            return self.__prune()
+
+    def __prune(self):
+        # Both go through an index, it is cheap enough for every put()
+        dropped = self.__db.execute("DELETE FROM outbox WHERE created < ?", (time.time() - self.max_age,)).rowcount
+        dropped += self.__db.execute("DELETE FROM outbox WHERE id <= (SELECT id FROM outbox ORDER BY id DESC LIMIT 1 OFFSET ?)", (self.max_messages,)).rowcount
+        return dropped
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
@@ -24,15 +24,16 @@ functions under specific timeout. The function will raise an exception when
 timeout is reached if the called function didn't finish execution before
 '''
 
-__version__ = "2017112900"
+__version__ = "2026101800"
 
 import time
-import queue
+import heapq
 import signal
-import ctypes
+import itertools
 import threading
+import concurrent.futures
 
-__all__ = ["TimedOutException", "timeout", "timeout2"]
+__all__ = ["TimedOutException", "timeout", "timeout2", "Deadline", "scheduler"]
 
 
 class TimedOutException(Exception):
@@ -95,121 +96,175 @@ def timeout(f, timeout, *args, **kwargs):
     return result
 
 
-class ThreadedCMD(threading.Thread):
-
-    def __init__(self, result, f, args=(), kwargs={}):
-        # Initialice thread
-        super(ThreadedCMD, self).__init__()
+class DeadlineScheduler(threading.Thread):
+    '''
+    One thread for all deadlines of the program: it keeps them in a heap and
+    sleeps until the nearest one expires (or a nearer one is added), then it
+    calls its callback
+    '''
 
-        # Save incoming data
-        self.__f = f
-        self.__args = args
-        self.__kwargs = kwargs
-        self.__result = result
+    def __init__(self):
+        super(DeadlineScheduler, self).__init__(name="DeadlineScheduler", daemon=True)
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__condition = threading.Condition()
 
-        # Save exceptions if any
-        self.__exception = None
+    def schedule(self, when, callback):
+        '''
+        Call callback() at time.monotonic() == when, return the entry to cancel it
+        '''
+        entry = [when, next(self.__counter), callback]
+        with self.__condition:
+            heapq.heappush(self.__heap, entry)
+            if self.__heap[0] is entry:
+                # It is the nearest one, wake up to wait for it
+                self.__condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        # Cancelled entries stay in the heap but do nothing
+        entry[2] = None
 
     def run(self):
-        # Call function an set result
-        try:
-            # Launch f()
-            result = self.__f(*self.__args, **self.__kwargs)
-            # Set result in the queue
-            self.__result.put(result)
-        except (Exception, KeyboardInterrupt) as e:
-            self.__exception = e
-
-    def exception(self):
-        if self.__exception:
-            return self.__exception
-        else:
-            return None
+        while True:
+            with self.__condition:
+                while not self.__heap or self.__heap[0][0] > time.monotonic():
+                    if self.__heap:
+                        self.__condition.wait(self.__heap[0][0] - time.monotonic())
+                    else:
+                        self.__condition.wait()
+                callback = heapq.heappop(self.__heap)[2]
+            if callback is not None:
+                try:
+                    callback()
+                except Exception:
+                    pass
+
+
+__scheduler = None
+__scheduler_lock = threading.Lock()
+
+
+def scheduler():
+    '''
+    Shared DeadlineScheduler (started the first time it is needed)
+    '''
+    global __scheduler
+    with __scheduler_lock:
+        if __scheduler is None:
+            __scheduler = DeadlineScheduler()
+            __scheduler.start()
+    return __scheduler
+
+
+class Deadline(object):
+    '''
+    Cooperative timeout for code running in its own thread: when the time is
+    over `cancel` is called (to close the port, socket, etc. it is blocked on)
+    and `expired` is set so loops can check it. Use it as a context manager
+    to disarm it when the work is done:
+
+        with Deadline(5, port.cancel_read) as deadline:
+            while not deadline.expired.is_set():
+                ...
+    '''
 
+    def __init__(self, timeout, cancel=None):
+        self.timeout = timeout
+        self.when = time.monotonic() + timeout
+        self.expired = threading.Event()
+        self.__cancel = cancel
+        self.__entry = scheduler().schedule(self.when, self.__expire)
 
-def terminate_thread(thread):
-    """Terminates a python thread from another thread.
+    def __expire(self):
+        self.expired.set()
+        if self.__cancel is not None:
+            self.__cancel()
 
-    :param thread: a threading.Thread instance
-    """
-    if not thread.isAlive():
-        return
+    def remaining(self):
+        return max(0, self.when - time.monotonic())
 
-    exc = ctypes.py_object(SystemExit)
-    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(
-        ctypes.c_long(thread.ident), exc)
-    if res == 0:
-        raise ValueError("nonexistent thread id")
-    elif res > 1:
-        # """if it returns a number greater than one, you're in trouble,
-        # and you should call it again with exc=NULL to revert the effect"""
-        ctypes.pythonapi.PyThreadState_SetAsyncExc(thread.ident, None)
-        raise SystemError("PyThreadState_SetAsyncExc failed")
+    def disarm(self):
+        scheduler().cancel(self.__entry)
 
+    def __enter__(self):
+        return self
 
-def timeout2(f, timeout, quit=None, reactivity=0.1, args=(), kwargs={}):
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disarm()
+
+
+def __settle(setter, value):
+    # Only the first outcome counts (the result or the timeout)
+    try:
+        setter(value)
+        return True
+    except concurrent.futures.InvalidStateError:
+        return False
+
+
+def timeout2(f, timeout, quit=None, reactivity=None, args=(), kwargs={}):
     '''
-    Function that controls the timeout of another function using only threads
+    Function that controls the timeout of another function using only threads:
+    f() runs in its own daemon thread and we wait on its future, which is
+    settled either by f() or by a Deadline in the shared scheduler, so we wake
+    up exactly when it finishes or when the time is over (no polling). A hung
+    f() never holds anybody else's slot.
 
     Parameters:
     - `f`: function to process under timeout control
     - `timeout`: total number of seconds to wait until timeout (not allowed 0 or less)
     - `quit`: function called with no arguments to request f() to finish
-    - `reactivity`: time that the algorithm will wait between checks (faster means more CPU it will consume)
+    - `reactivity`: not used anymore (kept for compatibility)
     - `args` & `kwargs`: to allow in this function any kind of parameters to be passed to function f
 
     Exceptions:
     - `IOError`: parameter error
     - `TimedOutException`: when timeout reach to the limit and the function is
-       still executing
+       still executing (it is asked to finish with quit() but it is not killed)
     '''
 
-    # Set startup
-    startup = time.time()
-
     # Control that timeout can not be zero or negative
     if timeout <= 0:
         raise IOError("Timeout can not be zero or less than zero")
 
-    # Prepare queue
-    result = queue.Queue()
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
 
-    th = ThreadedCMD(result, f, args, kwargs)
-    th.start()
-
-    # Wait until done
-    while th.isAlive():
-        diff = time.time() - startup
-        if diff > timeout:
-            # It has passed too much time, finish this!
-            break
-        else:
-            # Wait for another loop
-            try:
-                time.sleep(reactivity)
-            except (Exception, KeyboardInterrupt):
-                break
-
-    # Get exceptions if any
-    ex = th.exception()
-
-    # If the thread is still working and we are here, we must stop it!
-    if th.isAlive():
-        # Stop the thread
-        if quit:
-            quit()
-        terminate_thread(th)
-        # Raise exception since we didn't finish on time
-        if ex:
-            raise ex
-        else:
-            raise TimedOutException()
-    else:
-        # Return the result of the function
-        if ex:
-            raise ex
+    def run():
+        try:
+            result = f(*args, **kwargs)
+        except BaseException as e:
+            __settle(future.set_exception, e)
         else:
-            try:
-                return result.get(False)
-            except (Exception, KeyboardInterrupt):
-                return None
+            __settle(future.set_result, result)
+
+    with Deadline(timeout, lambda: __settle(future.set_exception, TimedOutException())) as deadline:
+        threading.Thread(target=run, name="timeout2", daemon=True).start()
+        try:
+            return future.result()
+        except TimedOutException:
+            # Too late, ask it to finish (it will end by itself)
+            if deadline.expired.is_set() and quit:
+                try:
+                    quit()
+                except Exception:
+                    # It may not be in a state to be asked (the timeout is what matters)
+                    pass
+            raise
+
+
+if __name__ == '__main__':
+    # Overhead of the timeout control on a fast call (like a connect to a near server)
+    rounds = 200
+    for delay in (0, 0.001, 0.01):
+        start = time.perf_counter()
+        for i in range(rounds):
+            timeout2(time.sleep, 5, args=(delay,))
+        total = (time.perf_counter() - start) / rounds
+        print("f() taking {:6.3f} ms: timeout2 returns after {:6.3f} ms ({:6.3f} ms overhead)".format(delay * 1000, total * 1000, (total - delay) * 1000))
+    start = time.perf_counter()
+    for i in range(rounds):
+        with Deadline(5):
+            pass
+    print("Deadline arm/disarm: {:6.3f} us".format((time.perf_counter() - start) / rounds * 1e6))
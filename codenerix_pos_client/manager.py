@@ -21,16 +21,19 @@
 
 import time
 import uuid
-import queue
+import threading
 
 from lib.debugger import Debugger
-from workers import POSWorker, POSWorkerNotFound
+from workers import POSWorker, POSQueue, POSWorkerNotFound, POSQueueFull
+from asyncworkers import AsyncRuntime, AsyncPOSWorker
 
 
 class QueueListener(POSWorker):
 
+    queue_size = 1000
     parent = None
     watchdog = None
+    updater = None
 
     def set_parent(self, parent):
         self.parent = parent
@@ -38,6 +41,9 @@ class QueueListener(POSWorker):
     def set_watchdog(self, uid):
         self.watchdog = uid.hex
 
+    def set_updater(self, uid):
+        self.updater = uid.hex
+
     def is_watchdog(self, uid):
         if self.watchdog:
             return uid == self.watchdog
@@ -49,7 +55,11 @@ class QueueListener(POSWorker):
         self.send(msg, ref, self.watchdog)
 
     def recv(self, msg, ref, uid=None):
-        if self.is_watchdog(self.get_uuid(uid)):
+        if self.updater and self.get_uuid(uid) == self.updater and msg == 'restart':
+            self.debug("Updater: Restart requested! (REF:{})".format(ref), color='white')
+            # Restarting stops us (the listener), it can not be done from our own thread
+            threading.Thread(target=self.parent.restart, name="Restart").start()
+        elif self.is_watchdog(self.get_uuid(uid)):
             if msg == 'close':
                 self.debug("Watchdog: Shutdown requested! (REF:{})".format(ref), color='white')
                 # Close websocket, so it will push the server to shutdown!
@@ -58,32 +68,68 @@ class QueueListener(POSWorker):
                 self.debug("Watchdog: Terminate requested! (REF:{})".format(ref), color='white')
                 # Close websocket, so it will push the server to shutdown!
                 self.parent.terminate()
+            elif isinstance(msg, dict) and 'pingdog' in msg:
+                # Heartbeat for the server (only if we are connected, otherwise it would never come back)
+                if self.parent.connected:
+                    self.parent.send({'action': 'pingdog', 'rtt': msg.get('rtt')}, str(msg['pingdog']))
             else:
                 self.error("Watchdog Unknown MSG: {} (REF:{})".format(msg, ref))
         else:
             if not msg or 'error' not in msg:
                 self.debug("Listener {}: {} (ref:{})".format(self.parent.uuid, msg, ref), color='cyan')
-                self.parent.send({'action': 'msg', 'uuid': self.get_uuid(uid), 'msg': msg}, ref)
+                self.forward({'action': 'msg', 'uuid': self.get_uuid(uid), 'msg': msg}, ref)
             else:
                 self.debug("Listener {}: {} (ref:{})".format(self.parent.uuid, msg, ref), color='red')
-                self.parent.send({'action': 'error', 'uuid': self.get_uuid(uid), 'error': msg.get('error')}, ref)
+                self.forward({'action': 'error', 'uuid': self.get_uuid(uid), 'error': msg.get('error')}, ref)
+
+    def forward(self, request, ref):
+        # Only durable workers go through the outbox, the rest is sent if we are connected or lost
+        worker = self.registry.get_worker(request['uuid'])
+        if worker is None or worker.durable:
+            self.parent.deliver(request, ref)
+        elif self.parent.connected:
+            self.parent.send(request, ref)
 
 
 class Manager(Debugger):
 
     __running = False
+    supervise_every = 2         # Seconds between checks of the workers
+    restart_backoff = 1         # Seconds to wait before the first restart of a crashed worker
+    restart_backoff_max = 60    # Maximum seconds between restarts
+    restart_forget_after = 300  # Seconds after which a crashed worker starts again from the first backoff
+    shutdown_timeout = 10       # Seconds all workers together have to stop on shutdown
+    control_messages = ('ping', 'cancel')   # Messages jumping ahead of everything else waiting in a worker
 
     def __init__(self):
         self.set_name("Manager")
         self.set_debug()
-        self.__workers = []
+        self.__lock = threading.RLock()
+        self.__workers = {}
+        self.__factories = {}
+        self.__signatures = {}
+        self.__restarts = {}
+        self.__supervisor = None
+        self.__supervisor_stop = threading.Event()
         self.__uuid = uuid.uuid4()
         self.__uuidhex = self.__uuid.hex
-        self.__listener = QueueListener(self.__uuid, {})
+        self.__listener = self.__new_listener()
         self.__parent = None
+        self.__runtime = None
+        self.__last_activity = time.monotonic()
+        self.__last_alive = None
+        self.last_shutdown = None
 
         # Attach to POSWorker class
-        self.queue = queue.Queue()
+        self.queue = POSQueue()
+
+    def __new_listener(self, old=None):
+        # Listener for the messages coming from the workers (it keeps what the old one knew)
+        listener = QueueListener(self.__uuid, {})
+        if old is not None:
+            listener.watchdog = old.watchdog
+            listener.updater = old.updater
+        return listener
 
     @property
     def isrunning(self):
@@ -98,10 +144,13 @@ class Manager(Debugger):
         return self.__uuidhex
 
     def exists_worker(self, uid):
-        for worker in self.__workers:
-            if worker.uuid == uid:
-                return True
-        return False
+        return uid in self.__workers
+
+    def get_signature(self, uid):
+        return self.__signatures.get(uid, None)
+
+    def signatures(self):
+        return dict(self.__signatures)
 
     def add_channel(self, name):
         self.__listener.add_channel(name)
@@ -116,21 +165,181 @@ class Manager(Debugger):
     def set_watchdog(self, uuid):
         self.__listener.set_watchdog(uuid)
 
-    def recv(self, msg, ref, target):
+    def set_updater(self, uuid):
+        self.__listener.set_updater(uuid)
+
+    def send_to_updater(self, msg, ref):
+        self.__listener.send(msg, ref, self.__listener.updater)
+
+    def alive(self):
+        # The server just sent us something
+        self.__last_alive = time.monotonic()
+
+    def last_alive(self):
+        return self.__last_alive
+
+    def idle(self):
+        # Seconds since the last message for a worker arrived
+        return time.monotonic() - self.__last_activity
+
+    def recv(self, msg, ref, target, priority=None):
         self.debug("Got message for {} (ref:{})".format(target, ref), color='yellow')
+        self.__last_activity = time.monotonic()
+
+        # Choose the lane from the message unless the server chose one
+        if priority is None:
+            priority = self.lane(msg, target)
+        elif priority not in POSQueue.LANES:
+            return "Priority '{}' is unknown, valid priorities are: {}".format(priority, ", ".join(POSQueue.LANES))
+
         try:
-            self.__listener.send(msg, ref, target)
+            self.__listener.send(msg, ref, target, priority)
             answer = None
         except POSWorkerNotFound as e:
             answer = str(e)
+        except POSQueueFull as e:
+            answer = "POSWorker with UUID '{}' is overloaded: {}".format(target, e)
         return answer
 
-    def attach(self, worker):
+    def lane(self, msg, target):
+        # Control messages go first whoever they are for, the rest go in the lane of
+        # the target worker (a cash drawer is always urgent, a ticket is not)
+        if msg in self.control_messages or (isinstance(msg, dict) and any(key in msg for key in self.control_messages)):
+            return 'control'
+        worker = POSWorker.registry.get_worker(target)
+        if worker is not None:
+            return worker.priority
+        else:
+            return None
+
+    def queue_stats(self):
+        stats = {self.uuidhex: self.__listener.queue_stats()}
+        for worker in self.__workers.values():
+            stats[worker.uuidhex] = worker.queue_stats()
+        return stats
+
+    def build(self, uid, factory):
+        '''
+        Build a worker with its factory, if it fails whoever was registered in
+        the bus with that UUID keeps its place (the worker registers itself
+        before its own checks had a chance to fail)
+        '''
+        uidhex = uid.hex
+        queue = POSWorker.registry.get_queue(uidhex)
+        worker = POSWorker.registry.get_worker(uidhex)
+        try:
+            return factory()
+        except Exception:
+            if queue is not None:
+                POSWorker.registry.register(uidhex, queue, worker)
+            else:
+                POSWorker.registry.unregister(uidhex)
+            raise
+
+    def attach(self, worker, factory=None, signature=None):
+        '''
+        factory: callable building a fresh copy of the worker, used to restart it if it crashes
+        signature: fingerprint of the worker configuration, to know if it changed later
+        '''
+        with self.__lock:
+            self.__add(worker, factory, signature)
+
+            # If we are already running, the worker starts right away
+            if self.__running and not worker.is_alive():
+                self.__start(worker)
+
+    def __add(self, worker, factory, signature):
         # Add parent to the list
         worker.parent(self.uuidhex, self.queue)
 
         # Append worker to workers
-        self.__workers.append(worker)
+        self.__workers[worker.uuid] = worker
+        if factory is not None:
+            self.__factories[worker.uuid] = factory
+        if signature is not None:
+            self.__signatures[worker.uuid] = signature
+
+    def __take(self, uid):
+        # Remove the worker from the list
+        worker = self.__workers.pop(uid, None)
+        self.__factories.pop(uid, None)
+        self.__signatures.pop(uid, None)
+        self.__restarts.pop(uid, None)
+        return worker
+
+    def __retire(self, uid, worker, timeout):
+        # Stop it and make sure it is not reachable anymore (unless somebody took its place already)
+        self.debug("Detaching {}".format(uid), color='blue')
+        try:
+            worker.join(timeout)
+        except RuntimeError:
+            pass
+        POSWorker.registry.unregister(worker.uuidhex, worker.mailbox)
+
+    def detach(self, uid, timeout=10):
+        with self.__lock:
+            worker = self.__take(uid)
+
+        # Waiting for it to stop must not block everybody else
+        if worker is not None:
+            self.__retire(uid, worker, timeout)
+
+        return worker
+
+    def replace(self, uid, worker, factory=None, timeout=10, signature=None):
+        # Put the new worker in the place of the old one
+        with self.__lock:
+            if factory is None:
+                factory = self.__factories.get(uid, None)
+            if signature is None:
+                signature = self.__signatures.get(uid, None)
+            restarts = self.__restarts.get(uid, None)
+            old = self.__take(uid)
+            self.__add(worker, factory, signature)
+            if restarts is not None and worker.uuid == uid:
+                self.__restarts[uid] = restarts
+
+        # Stop the old one out of the lock (it may take a while), the new one starts once it is gone
+        if old is not None:
+            self.__retire(uid, old, timeout)
+        with self.__lock:
+            if self.__running and self.__workers.get(worker.uuid, None) is worker and not worker.is_alive():
+                self.__start(worker)
+
+    def __supervise(self):
+        # Restart the workers that died without being asked to
+        while not self.__supervisor_stop.wait(self.supervise_every):
+            now = time.monotonic()
+            with self.__lock:
+                for worker in list(self.__workers.values()):
+                    if worker.crashed():
+                        self.__restart(worker, now)
+
+    def __restart(self, worker, now):
+        uid = worker.uuid
+        factory = self.__factories.get(uid, None)
+        (count, last) = self.__restarts.get(uid, (0, None))
+
+        # Forget old crashes
+        if last is not None and now - last > self.restart_forget_after:
+            count = 0
+            last = None
+
+        if factory is None:
+            if count == 0:
+                self.error("Worker {} crashed and I don't know how to restart it".format(uid))
+                self.__restarts[uid] = (1, now)
+        else:
+            # Wait before restarting it, longer every time it crashes
+            wait = min(self.restart_backoff * (2 ** count), self.restart_backoff_max)
+            if last is None or now - last >= wait:
+                self.warning("Worker {} crashed, restarting it (restart number {})".format(uid, count + 1))
+                try:
+                    self.replace(uid, self.build(uid, factory), factory, 0)
+                    self.__restarts[uid] = (count + 1, now)
+                except Exception as e:
+                    self.error("Worker {} couldn't be restarted: {}".format(uid, e))
+                    self.__restarts[uid] = (count + 1, now)
 
     def run(self, parent):
         # Refresh parent
@@ -140,39 +349,108 @@ class Manager(Debugger):
         # Manager is running
         self.__running = True
 
-        if not self.__listener.isAlive():
+        if not self.__listener.is_alive():
+            if self.__listener.ident is not None:
+                # It was stopped by shutdown() and a thread can not be started twice
+                self.__listener = self.__new_listener(self.__listener)
+                self.__listener.set_parent(parent)
             self.debug("Starting listener", color='blue')
-            try:
-                self.__listener.start()
-            except RuntimeError:
-                pass
+            self.__listener.start()
 
         # Start all workers
         self.debug("waiting for workers to get ready", color='blue')
-        for worker in self.__workers:
-            if not worker.isAlive():
-                worker.start()
-
-    def shutdown(self):
-        # Ask threads to die and wait for them to do it
+        with self.__lock:
+            for worker in self.__workers.values():
+                if not worker.is_alive():
+                    self.__start(worker)
+
+        # Start the supervisor
+        if self.__supervisor is None:
+            self.__supervisor_stop.clear()
+            self.__supervisor = threading.Thread(target=self.__supervise, daemon=True)
+            self.__supervisor.start()
+
+    def __start(self, worker):
+        if isinstance(worker, AsyncPOSWorker):
+            # Asyncio workers are tasks in the runtime
+            if self.__runtime is None:
+                self.__runtime = AsyncRuntime()
+                self.__runtime.start()
+            worker.spawn(self.__runtime)
+        else:
+            worker.start()
+
+    def shutdown(self, timeout=None):
+        '''
+        Stop all workers against a single deadline and return a report with
+        the time it took and the workers that didn't make it
+        '''
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        # Stop the supervisor
+        if self.__supervisor is not None:
+            self.__supervisor_stop.set()
+            self.__supervisor.join()
+            self.__supervisor = None
+
+        # Take all workers out
+        with self.__lock:
+            workers = list(self.__workers.values())
+            self.__workers.clear()
+            self.__factories.clear()
+            self.__signatures.clear()
+            self.__restarts.clear()
+
+        # Ask all of them to die at once
         self.debug("waiting for workers to finish", color='blue')
-        while len(self.__workers):
-            # Pop first worker from the list (we will pop them the same we we appended them)
-            worker = self.__workers.pop(0)
-            # self.debug("    > Waiting for {} to stop...".format(worker.uuid), color='cyan')
+        for worker in workers:
+            worker.stop()
+
+        # Wait for them to do it, each one in its own thread so we know when every one was gone
+        timing = {}
+
+        def wait(worker):
             try:
-                # Request it to finish
-                worker.join(10)
+                worker.join(max(0, deadline - time.monotonic()))
             except RuntimeError:
+                # Never started
                 pass
+            if not worker.is_alive():
+                timing[worker.uuidhex] = time.monotonic() - started
+
+        waiters = [threading.Thread(target=wait, args=(worker, ), daemon=True) for worker in workers]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join(max(0, deadline - time.monotonic()))
+        missed = [worker.uuidhex for worker in workers if worker.is_alive()]
+
+        # Stop the asyncio runtime
+        if self.__runtime is not None:
+            self.__runtime.stop(max(0, deadline - time.monotonic()))
+            self.__runtime = None
+
         self.__running = False
-        self.debug("finished", color='green')
+        elapsed = time.monotonic() - started
+        if missed:
+            self.warning("Workers didn't stop in {} seconds: {}".format(timeout, ", ".join(missed)))
+        self.debug("finished in {:.3f} seconds".format(elapsed), color='green')
+        self.last_shutdown = {'elapsed': elapsed, 'timeout': timeout, 'workers': timing, 'missed': missed}
 
-        if not self.__listener.isAlive():
+        if self.__listener.is_alive():
             self.debug("Stopping listener", color='blue')
-            self.__listener.join()
+            if self.__listener is threading.current_thread():
+                # Called from the listener itself, it will stop when it gets back to its loop
+                self.__listener.stop()
+            else:
+                self.__listener.join()
             self.debug("finished", color='green')
 
+        return self.last_shutdown
+
 
 if __name__ == '__main__':
     from workers import POSWorker
@@ -184,6 +462,11 @@ if __name__ == '__main__':
         def send(self, msg, ref):
             pass
 
+        def deliver(self, msg, ref):
+            pass
+
+        connected = True
+
     parent = Parent()
 
     for i in range(0, 3):
@@ -2,9 +2,15 @@
 # encoding: utf-8
 
 import os
-import json
+import sys
 import uuid
 import time
+import random
+import zlib
+import hashlib
+import resource
+import functools
+import threading
 
 try:
     from subprocess import getstatusoutput
@@ -16,6 +22,8 @@ from ws4py.exc import HandshakeError
 
 from lib.debugger import Debugger
 from lib.cryptography import AESCipher
+from lib import codec
+from lib.outbox import Outbox
 from lib.timeout import timeout2, TimedOutException
 
 from __init__ import __version_name__
@@ -23,15 +31,50 @@ from __init__ import __version_name__
 from manager import Manager
 from webserver import WebServer
 from watchdog import Watchdog
+from updater import Updater
+from processes import POSProcessWorker
 
 from hardware import POSWeight, POSTicketPrinter, POSCashDrawer, POSDNIe, HardwareError
 
 import config
 
+# When we started to know how long we take to be ready (drivers are loaded later, when configured)
+STARTUP = time.monotonic()
+
+# Use the JSON library requested in config (fastest one available by default)
+codec.select(getattr(config, 'JSON_CODEC', 'auto'))
+
 
 class POSClient(WebSocketClient, Debugger):
 
     CONNECT_TIMEOUT = 5
+    RECONNECT_BACKOFF = 1           # Seconds before the second reconnection (the first one is immediate)
+    RECONNECT_BACKOFF_MAX = 60      # Maximum seconds between reconnections
+    TRANSPORTS = ['gcm', 'cbc']     # Transports we can talk, in order of preference
+    COMPRESSIONS = ['zlib']         # Compressions we understand
+    COMPRESS_THRESHOLD = 1024       # Messages from this size (bytes) get compressed (if negotiated)
+    COMPRESS_LEVEL = 6              # zlib level
+    MAX_MESSAGE = 1 << 24           # Biggest message we accept once decompressed
+    BATCH_WINDOW = 0.02             # Seconds outgoing messages wait to be sent together (if negotiated)
+    BATCH_SIZE = 32                 # Messages that fill a batch and get sent right away
+    FRAME_GCM = 1                   # First byte of a binary AES-GCM frame
+    FRAME_GCM_ZLIB = 2              # First byte of a binary AES-GCM frame carrying a zlib compressed message
+    FRAME_VERSION = 1               # Version of the text frames ('type' says what they carry)
+
+    # Handlers for each kind of frame and for the actions allowed without encryption
+    BINARY_FRAMES = {
+        FRAME_GCM: 'received_gcm',
+        FRAME_GCM_ZLIB: 'received_gcm_zlib',
+    }
+    TEXT_FRAMES = {
+        'cbc': 'received_cbc',
+        'cbc-zlib': 'received_cbc_zlib',
+        'plain': 'received_plain',
+    }
+    UNPROTECTED_ACTIONS = {
+        'pongdog': 'unprotected_pongdog',
+        'pong': 'unprotected_pong',
+    }
     AVAILABLE_HARDWARE = {
         'WEIGHT': POSWeight,
         'TICKET': POSTicketPrinter,
@@ -40,6 +83,10 @@ class POSClient(WebSocketClient, Debugger):
     }
 
     manager = Manager()
+    outbox = None
+    config_applied = None   # Signature of the hardware configuration the manager is running
+    identity = None         # Commit we are running (see commit_identity())
+    startup = STARTUP       # When the program started (None once we asked for config)
 
     def __init__(self, *args, **kwargs):
         # Set debugger
@@ -54,102 +101,451 @@ class POSClient(WebSocketClient, Debugger):
         self.uuid = uuid.UUID(config.UUID)
         self.uuidhex = self.uuid.hex
         self.__encrypt = False
+        self.__transport = 'cbc'
+        self.__compression = None
+        self.__compress_threshold = getattr(config, 'COMPRESS_THRESHOLD', self.COMPRESS_THRESHOLD)
+        self.__compression_stats = {}
+        self.__batching = False
+        self.__batch_window = getattr(config, 'BATCH_WINDOW', self.BATCH_WINDOW)
+        self.__batch_lock = threading.Lock()
+        self.__batch = []
+        self.__batch_timer = None
+        self.__connected = False
+        self.__aborted = False
+        self.__replay_lock = threading.Lock()
+        self.__wakeup = threading.Event()
+
+        # Messages that must reach the server wait on disk (shared by all connections)
+        if POSClient.outbox is None:
+            POSClient.outbox = Outbox(
+                getattr(config, 'OUTBOX_PATH', 'outbox.db'),
+                getattr(config, 'OUTBOX_MAX_MESSAGES', 10000),
+                getattr(config, 'OUTBOX_MAX_AGE', 7 * 86400),
+            )
         self.__fully_configured = False
         self.__force_version = getattr(config, 'FORCE_VERSION', None)
 
         # Get on which commit are we working
-        if self.__force_version:
-            # Not autoupdating
-            self.__commit = self.__force_version
-        else:
-            # Autoupdate
-            if os.path.exists("commit.dat"):
-                commit = open("commit.dat", "r").read().split("\n")[0]
-            else:
-                commit = None
-
-            # Find real commit
-            # cmd = "git show --format='%H' --no-patch"   # Long HASH
-            cmd = "git show --format='%h' --no-patch"   # Short HASH
-            status, output = getstatusoutput(cmd)
-            if status:
-                realcommit = None
-            else:
-                realcommit = output
+        self.__commit = self.commit_identity()
+
+        # Keep going with warm up
+        super(POSClient, self).__init__(*args, **kwargs)
 
-            # Build answer
-            if commit == realcommit:
-                answer = commit
+    @classmethod
+    def commit_identity(cls):
+        '''
+        Commit we are running, worked out once (until an update changes it)
+        '''
+        if cls.identity is None:
+            force_version = getattr(config, 'FORCE_VERSION', None)
+            if force_version:
+                # Not autoupdating
+                identity = force_version
             else:
-                if commit and realcommit:
-                    answer = "{}:{}".format(commit, realcommit)
-                elif commit:
-                    answer = "{}:NOREAL".format(commit)
-                elif realcommit:
-                    answer = "NODATA:{}".format(realcommit)
+                # Autoupdate
+                if os.path.exists("commit.dat"):
+                    commit = open("commit.dat", "r").read().split("\n")[0]
                 else:
-                    answer = "NODATA:NOREAL"
+                    commit = None
+
+                # Find real commit
+                # cmd = "git show --format='%H' --no-patch"   # Long HASH
+                cmd = "git show --format='%h' --no-patch"   # Short HASH
+                status, output = getstatusoutput(cmd)
+                if status:
+                    realcommit = None
+                else:
+                    realcommit = output
 
-            # Set commit version
-            self.__commit = answer
+                # Build answer
+                if commit == realcommit:
+                    answer = commit
+                else:
+                    if commit and realcommit:
+                        answer = "{}:{}".format(commit, realcommit)
+                    elif commit:
+                        answer = "{}:NOREAL".format(commit)
+                    elif realcommit:
+                        answer = "NODATA:{}".format(realcommit)
+                    else:
+                        answer = "NODATA:NOREAL"
 
-        # Keep going with warm up
-        super(POSClient, self).__init__(*args, **kwargs)
+                # Set commit version
+                identity = answer
+
+            cls.identity = identity
+        return cls.identity
 
     @property
     def encrypt(self):
         return self.__encrypt
 
+    @property
+    def connected(self):
+        return self.__connected
+
+    @property
+    def configured(self):
+        return self.__fully_configured
+
+    def wait_configured(self, timeout=None):
+        '''
+        Wait until the server configured us or the connection is gone, return True if configured
+        '''
+        self.__wakeup.wait(timeout)
+        return self.__fully_configured
+
+    @property
+    def transport(self):
+        return self.__transport
+
+    def set_transport(self, transport):
+        if transport in self.TRANSPORTS:
+            if transport != self.__transport:
+                self.debug("Switching transport to {}".format(transport.upper()), color='cyan')
+                self.__transport = transport
+        else:
+            self.warning("Server asked for unknown transport '{}', keeping {}".format(transport, self.__transport.upper()))
+
+    @property
+    def compression(self):
+        return self.__compression
+
+    def set_compression(self, compression):
+        if compression is None or compression in self.COMPRESSIONS:
+            if compression != self.__compression:
+                self.debug("Switching compression to {}".format(compression), color='cyan')
+                self.__compression = compression
+        else:
+            self.warning("Server asked for unknown compression '{}', keeping {}".format(compression, self.__compression))
+
+    def compression_stats(self):
+        '''
+        Compressed messages grouped by size (the bucket is the power of 2 below
+        the raw size): count, raw bytes, compressed bytes and ratio
+        '''
+        stats = {}
+        for (bucket, (count, raw, compressed)) in self.__compression_stats.items():
+            stats[bucket] = {'count': count, 'raw': raw, 'compressed': compressed, 'ratio': compressed / raw}
+        return stats
+
+    def pack(self, msg):
+        '''
+        Compress the message if it is worth it, return (data, compressed)
+        '''
+        data = msg.encode('utf-8')
+        if self.__compression == 'zlib' and len(data) >= self.__compress_threshold:
+            compressed = zlib.compress(data, self.COMPRESS_LEVEL)
+
+            # Keep statistics
+            bucket = 1 << (len(data).bit_length() - 1)
+            (count, raw, packed) = self.__compression_stats.get(bucket, (0, 0, 0))
+            self.__compression_stats[bucket] = (count + 1, raw + len(data), packed + len(compressed))
+            self.debug("Compressed {} bytes to {} ({:.1%})".format(len(data), len(compressed), len(compressed) / len(data)), color='white')
+
+            if len(compressed) < len(data):
+                return (compressed, True)
+
+        return (data, False)
+
+    def unpack(self, data):
+        # Decompress a message without letting it grow beyond MAX_MESSAGE
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, self.MAX_MESSAGE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Message is bigger than {} bytes".format(self.MAX_MESSAGE))
+        # Server compresses, answer the same way
+        self.set_compression('zlib')
+        return data
+
+    @property
+    def batching(self):
+        return self.__batching
+
+    def set_batching(self, batching):
+        batching = bool(batching) and self.__batch_window > 0
+        if batching != self.__batching:
+            self.debug("Batching of outgoing messages is {}".format(batching and 'ON' or 'OFF'), color='cyan')
+            if not batching:
+                self.flush()
+            self.__batching = batching
+
     def shutdown(self):
+        try:
+            self.flush()
+        except Exception as e:
+            self.warning("Pending messages couldn't be sent: {}".format(e))
         if self.manager.isrunning:
             self.manager.shutdown()
+        # The devices are gone, the next configuration must be applied again
+        POSClient.config_applied = None
+
+    def restart(self):
+        '''
+        Start the program again (to run a new version)
+        '''
+        self.warning("Restarting to run the new version")
+        self.shutdown()
+        try:
+            self.close(reason='Restarting')
+        except Exception:
+            pass
+        os.execv(sys.executable, [sys.executable] + sys.argv)
 
     def shutdown_external(self):
         self.shutdown()
         self.close(reason='Shutdown requested by external program')
 
+    def abort_connect(self):
+        '''
+        Give up a connect() that is taking too long: the socket is shut down so the
+        handshake fails, and if it made it anyway the connection is not used
+        '''
+        self.__aborted = True
+        self.close_connection()
+
     def opened(self):
+        if self.__aborted:
+            self.debug("Connection opened too late, dropping it", color="yellow")
+            self.close_connection()
+            return
         self.debug("Connection opened", color="blue")
+        self.__connected = True
         self.configure()
 
     def configure(self):
         self.debug("Requesting config", color="blue")
-        self.send({'action': 'get_config'}, None)
+        if POSClient.startup is not None:
+            self.debug("First get_config {:.3f} seconds after start (peak RSS {} KB)".format(time.monotonic() - POSClient.startup, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss), color='white')
+            POSClient.startup = None
+        self.send(self.get_config_message(), None)
+
+    def get_config_message(self):
+        # What this client can do goes with every request for the config
+        return {'action': 'get_config', 'transports': self.TRANSPORTS, 'compressions': self.COMPRESSIONS, 'batch': self.__batch_window > 0}
 
     def closed(self, code, reason=None):
+        self.__connected = False
+        self.__wakeup.set()
         self.debug("Websocket closed", color="blue")
 
     def send_error(self, msg, ref=None, uid=None):
         self.error("{} (ref:{})".format(msg, ref))
+        if not self.__connected:
+            # Nobody to tell (warm start)
+            return
         msg = {'action': 'error', 'error': msg}
         if uid:
             msg['uuid'] = uid.hex
         if self.encrypt:
             self.send(msg, ref)
         else:
-            super(POSClient, self).send(json.dumps({'message': msg}))
+            super(POSClient, self).send(codec.dumps({'type': 'plain', 'version': self.FRAME_VERSION, 'message': msg}))
+
+    def frame_header(self, kind=FRAME_GCM):
+        # Frame kind + our UUID, sent in clear but authenticated
+        return bytes([kind]) + self.uuid.bytes
 
     def send(self, request, ref):
-        # Encode request
-        msg = json.dumps({'request': request, 'ref': ref})
+        if self.__batching:
+            # Wait a little for other messages to go together
+            with self.__batch_lock:
+                self.__batch.append({'request': request, 'ref': ref})
+                if len(self.__batch) >= self.BATCH_SIZE:
+                    full = True
+                else:
+                    full = False
+                    if self.__batch_timer is None:
+                        self.__batch_timer = threading.Timer(self.__batch_window, self.flush_timer)
+                        self.__batch_timer.daemon = True
+                        self.__batch_timer.start()
+            if full:
+                self.flush()
+        else:
+            self.transmit(request, ref)
+
+    def deliver(self, request, ref):
+        '''
+        Send a message that must reach the server: it waits on disk until it goes out
+        '''
+        self.outbox.put(codec.dumps(request), ref)
+        self.replay()
+
+    def replay(self):
+        # Send everything waiting in the outbox, in order
+        with self.__replay_lock:
+            while self.__connected:
+                pending = self.outbox.pending(self.BATCH_SIZE)
+                if not pending:
+                    break
+                requests = [codec.loads(payload) for (_, payload, _) in pending]
+                try:
+                    for (request, (_, _, ref)) in zip(requests, pending):
+                        self.send(request, ref)
+                    self.flush()
+                except Exception as e:
+                    # They stay in the outbox, don't keep them in the batch too
+                    self.unbatch(requests)
+                    self.warning("Outbox couldn't be sent, {} messages will wait for the next connection: {}".format(len(self.outbox), e))
+                    break
+                self.outbox.done([i[0] for i in pending])
+
+    def flush(self):
+        # Send whatever is waiting in the batch
+        with self.__batch_lock:
+            batch = self.__batch
+            self.__batch = []
+            if self.__batch_timer is not None:
+                self.__batch_timer.cancel()
+                self.__batch_timer = None
+            try:
+                if len(batch) == 1:
+                    self.transmit(batch[0]['request'], batch[0]['ref'])
+                elif batch:
+                    self.transmit({'action': 'batch', 'messages': batch}, None)
+            except Exception:
+                # Nothing went out, keep the batch in front of what came meanwhile
+                self.__batch = batch + self.__batch
+                raise
+
+    def unbatch(self, requests):
+        # Remove these requests from the batch
+        requests = set(id(request) for request in requests)
+        with self.__batch_lock:
+            self.__batch = [item for item in self.__batch if id(item['request']) not in requests]
+
+    def flush_timer(self):
+        # The batch window is over (nobody is there to get an exception)
+        try:
+            self.flush()
+        except Exception as e:
+            self.warning("Batch couldn't be sent, {} messages will wait for the next one: {}".format(len(self.__batch), e))
+
+    def transmit(self, request, ref):
+        # Encode request (and compress it if it is big)
+        (data, compressed) = self.pack(codec.dumps({'request': request, 'ref': ref}))
+
+        if self.__transport == 'gcm':
+            # Binary frame: HEADER+NONCE+ENCRYPTED+TAG
+            if compressed:
+                header = self.frame_header(self.FRAME_GCM_ZLIB)
+            else:
+                header = self.frame_header(self.FRAME_GCM)
+            super(POSClient, self).send(header + self.crypto.encrypt_gcm(data, config.KEY, header), binary=True)
+            return
 
         # Build query
         query = {
             'uuid': self.uuidhex,
-            'message': self.crypto.encrypt(msg, config.KEY).decode('utf-8'),
+            'type': compressed and 'cbc-zlib' or 'cbc',
+            'version': self.FRAME_VERSION,
+            'message': self.crypto.encrypt(data, config.KEY).decode('utf-8'),
         }
 
         # Encode to JSON
-        data = json.dumps(query)
+        data = codec.dumps(query)
 
         # Send to remote
         super(POSClient, self).send(data)
 
+    def received_query(self, query):
+        # Check if we have something to work on
+        if isinstance(query, dict):
+            request = query.get('request', None)
+            if request is not None:
+                ref = query.get('ref')
+                if isinstance(request, dict):
+                    self.debug("Receive: {}".format(request), color='cyan')
+                    self.recv(request, ref)
+                else:
+                    self.send_error("Message is not a Dictionary", ref)
+            else:
+                self.error("Message doesn't belong to CODENERIX POS")
+        else:
+            self.send_error("Message is not a Dictionary")
+
+    def received_gcm(self, data, compressed=False):
+        # Binary frame: HEADER+NONCE+ENCRYPTED+TAG
+        header = self.frame_header(data[0])
+        if data[:len(header)] == header:
+            try:
+                msg = self.crypto.decrypt_gcm(data[len(header):], config.KEY, header)
+                if compressed:
+                    msg = self.unpack(msg)
+                query = codec.loads(msg)
+            except (ValueError, KeyError, zlib.error):
+                self.send_error("Binary frame couldn't be authenticated or decoded, we have the wrong KEY")
+            else:
+                # Whatever comes from the server proves it is there (the watchdog may beat slower)
+                self.manager.alive()
+                # Server talks GCM, answer the same way
+                self.__encrypt = True
+                self.set_transport('gcm')
+                self.received_query(query)
+        else:
+            self.send_error("Binary frame is not for me")
+
+    def received_gcm_zlib(self, data):
+        self.received_gcm(data, True)
+
+    def received_cbc(self, message, compressed=False):
+        try:
+            msg = self.crypto.decrypt(message, config.KEY, text=False)
+            if compressed:
+                msg = self.unpack(msg)
+            query = codec.loads(msg)
+        except Exception:
+            self.warning("Message is not encrypted or we have the wrong KEY")
+        else:
+            self.manager.alive()
+            self.__encrypt = True
+            self.received_query(query)
+
+    def received_cbc_zlib(self, message):
+        self.received_cbc(message, True)
+
+    def received_plain(self, message):
+        if isinstance(message, str):
+            try:
+                message = codec.loads(message)
+            except ValueError:
+                message = None
+        if isinstance(message, dict):
+            action = message.get('action', None)
+            if action is None:
+                self.manager.alive()
+                self.received_query(message)
+            elif action in self.UNPROTECTED_ACTIONS:
+                self.manager.alive()
+                getattr(self, self.UNPROTECTED_ACTIONS[action])(message.get('ref', None))
+            else:
+                self.send_error("I can not understand unprotected CMD '{}'".format(action))
+        else:
+            self.warning("Message is not encrypted or we have the wrong KEY")
+
+    def unprotected_pongdog(self, ref):
+        # Give answer to manager (with the time it arrived, the watchdog may look at it later)
+        self.manager.send_to_watchdog({'pongdog': time.monotonic()}, ref)
+
+    def unprotected_pong(self, ref):
+        # Do nothing!
+        self.debug("Got PONG (ref:{})".format(ref), color='white')
+
     def received_message(self, package):
         # self.debug("New message arrived: {}".format(package), color='yellow')
 
+        if package.is_binary:
+            # Binary frames say what they are in their first byte
+            data = package.data
+            handler = self.BINARY_FRAMES.get(data[0] if data else None, None)
+            if handler is not None:
+                getattr(self, handler)(data)
+            else:
+                self.send_error("Binary frame has an unknown format")
+            return
+
         try:
-            request = json.loads(package.data.decode('utf-8'))
+            request = codec.loads(package.data)
         except Exception:
             request = None
 
@@ -157,59 +553,19 @@ class POSClient(WebSocketClient, Debugger):
         if request is not None and isinstance(request, dict):
             message = request.get('message', None)
             if message is not None:
-
-                # Decrypt message
-                unprotected_cmd = None
-                try:
-                    msg = self.crypto.decrypt(message, config.KEY)
-                    self.__encrypt = True
-                except Exception:
-                    # Not encrypted
-                    msg = message
-                    # Check the json here
-                    try:
-                        unprotected_cmd = json.loads(message).get('action')
-                        try:
-                            unprotected_ref = json.loads(message).get('ref')
-                        except Exception:
-                            unprotected_ref = None
-                    except Exception:
-                        self.warning("Message is not encrypted or we have the wrong KEY")
-
-                if not unprotected_cmd:
-                    # Get the json from it
-                    try:
-                        query = json.loads(msg)
-                    except Exception:
-                        query = None
-
-                    # Check if we have something to work on
-                    if query is not None and isinstance(query, dict):
-                        request = query.get('request', None)
-                        if request is not None:
-                            ref = query.get('ref')
-                            if isinstance(request, dict):
-                                self.debug("Receive: {}".format(request), color='cyan')
-                                self.recv(request, ref)
-                            else:
-                                self.send_error("Message is not a Dictionary", ref)
-                        else:
-                            self.error("Message doesn't belong to CODENERIX POS")
+                # Find out what kind of frame we got (old servers don't say it, but Base64 never starts with '{')
+                kind = request.get('type', None)
+                if kind is None:
+                    if isinstance(message, str) and not message.startswith('{'):
+                        kind = 'cbc'
                     else:
-                        if request is None:
-                            self.send_error("Message is not JSON or is None")
-                        else:
-                            self.send_error("Message is not a Dictionary")
+                        kind = 'plain'
+                version = request.get('version', self.FRAME_VERSION)
+                handler = self.TEXT_FRAMES.get(kind, None)
+                if handler is None or version != self.FRAME_VERSION:
+                    self.send_error("Unknown frame '{}' version {}".format(kind, version))
                 else:
-                    # Get and unprotected_cmd
-                    if unprotected_cmd == 'pongdog':
-                        # Give answer to manager
-                        self.manager.send_to_watchdog('pongdog', unprotected_ref)
-                    elif unprotected_cmd == 'pong':
-                        # Do nothing!
-                        self.debug("Got PONG {} (ref:{}) - {}".format(unprotected_ref), color='white')
-                    else:
-                        self.send_error("I can not understand unprotected CMD '{}'".format(unprotected_cmd))
+                    getattr(self, handler)(message)
             else:
                 self.send_error("Missing 'message' or is None")
         else:
@@ -218,20 +574,152 @@ class POSClient(WebSocketClient, Debugger):
             else:
                 self.send_error("Request is not a Dictionary")
 
-    def recv(self, message, ref):
-        action = message.get('action', None)
-
-        if action == 'config':
-            if self.manager.isrunning:
-                self.debug("Reconfiguration process: Shutting down Manager", color='cyan')
-                self.manager.shutdown()
+    def build_worker(self, kind, uid, hwconfig):
+        if kind in getattr(config, 'ISOLATED_HARDWARE', []):
+            # Host this device in its own process
+            return POSProcessWorker(self.AVAILABLE_HARDWARE.get(kind), uid, hwconfig)
+        else:
+            return self.AVAILABLE_HARDWARE.get(kind)(uid, hwconfig)
 
+    def start_manager(self):
+        if self.manager.isrunning:
+            # Keep running what didn't change (workers survive reconnections, they only get bound to this connection)
+            self.debug("Reconfiguration process: Updating Manager", color='cyan')
+            # This is a new connection, the watchdog starts again from scratch
+            self.manager.send_to_watchdog('reset', None)
+        else:
             # Initialize manager
             self.debug("Starting up manager", color='blue')
-            self.manager.attach(WebServer(uuid.uuid4(), 'Local Webserver', self.__commit))
+            factory = functools.partial(WebServer, uuid.uuid4(), 'Local Webserver', self.__commit)
+            self.manager.attach(factory(), factory)
             watchdog_uuid = uuid.uuid4()
-            self.manager.attach(Watchdog(watchdog_uuid, 'Watchdog', self))
+            factory = functools.partial(Watchdog, watchdog_uuid, 'Watchdog', self.manager.last_alive)
+            self.manager.attach(factory(), factory)
             self.manager.set_watchdog(watchdog_uuid)
+            updater_uuid = uuid.uuid4()
+            factory = functools.partial(Updater, updater_uuid, 'Updater', self.manager.idle)
+            self.manager.attach(factory(), factory)
+            self.manager.set_updater(updater_uuid)
+
+    @staticmethod
+    def config_signature(hardware):
+        # Fingerprint of the whole hardware configuration
+        return hashlib.sha1(codec.dumps(hardware, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def save_config(self, hardware):
+        '''
+        Keep the hardware configuration on disk (encrypted with our KEY) for the next start
+        '''
+        path = getattr(config, 'CONFIG_CACHE', 'config.cache')
+        try:
+            data = self.crypto.encrypt(codec.dumps(hardware), config.KEY)
+            with open(path + '.tmp', 'wb') as F:
+                F.write(data)
+                F.flush()
+                os.fsync(F.fileno())
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            self.warning("Configuration couldn't be cached: {}".format(e))
+
+    def load_config(self):
+        # Hardware configuration from the last time (None if there is no usable one)
+        path = getattr(config, 'CONFIG_CACHE', 'config.cache')
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as F:
+                    hardware = codec.loads(self.crypto.decrypt(F.read(), config.KEY))
+            except Exception as e:
+                self.warning("Cached configuration couldn't be read (wrong KEY?): {}".format(e))
+            else:
+                if isinstance(hardware, list):
+                    return hardware
+        return None
+
+    def warm_start(self):
+        '''
+        Bring up the hardware from the cached configuration so it works before the server answers
+        '''
+        hardware = self.load_config()
+        if hardware is not None:
+            self.debug("Warm start from the cached configuration", color='blue')
+            self.start_manager()
+            error = self.configure_hardware(hardware, None)
+            self.manager.run(self)
+            if not error:
+                POSClient.config_applied = self.config_signature(hardware)
+
+    @staticmethod
+    def hardware_signature(kind, hwconfig):
+        # Fingerprint of a device configuration, used to find out what changed
+        return hashlib.sha1(codec.dumps([kind, hwconfig], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def configure_hardware(self, hardware, ref):
+        '''
+        Bring the running devices in line with the given hardware list: start
+        the new ones, restart the ones whose configuration changed and stop the
+        ones that are gone. Return True if some device couldn't be set up.
+        '''
+
+        # Remember what devices we should have
+        wanted = set()
+
+        error = False
+        for hw in hardware:
+            # Get details
+            uuidtxt = hw.get('uuid', None)
+            kind = hw.get('kind', '')
+            hwconfig = hw.get('config', {})
+
+            if uuidtxt is not None:
+                uid = uuid.UUID(uuidtxt)
+                wanted.add(uid)
+                signature = self.hardware_signature(kind, hwconfig)
+                if self.manager.get_signature(uid) != signature:
+                    exists = self.manager.exists_worker(uid)
+                    if exists:
+                        self.debug("    > Reconfiguring ", color='yellow', tail=False)
+                    else:
+                        self.debug("    > Configuring ", color='yellow', tail=False)
+                    self.debug(str(uid), color='purple', head=False, tail=False)
+                    self.debug(" as ", color='yellow', head=False, tail=False)
+                    if kind in self.AVAILABLE_HARDWARE:
+                        self.debug(kind, color='white', head=False)
+                        try:
+                            factory = functools.partial(self.build_worker, kind, uid, hwconfig)
+                            worker = self.manager.build(uid, factory)
+                            if exists:
+                                self.manager.replace(uid, worker, factory, signature=signature)
+                            else:
+                                self.manager.attach(worker, factory, signature=signature)
+                        except HardwareError as e:
+                            self.send_error("Device {} as {} is wrong configured: {}".format(uid, kind, e), ref, uid)
+                            error = True
+                    else:
+                        self.debug("{}??? - Not setting it up!".format(kind), color='red', head=False)
+            else:
+                self.error("    > I found a hardware configuration without UUID, I will not set it up!")
+
+        # Stop devices that are not in the configuration anymore
+        for uid in self.manager.signatures().keys():
+            if uid not in wanted:
+                self.debug("    > Removing {}".format(uid), color='yellow')
+                self.manager.detach(uid)
+
+        return error
+
+    def recv(self, message, ref):
+        action = message.get('action', None)
+
+        if action == 'config':
+            # Transport chosen by the server (old servers don't say anything)
+            if 'transport' in message:
+                self.set_transport(message['transport'])
+            if 'compression' in message:
+                self.set_compression(message['compression'])
+            if 'batch' in message:
+                self.set_batching(message['batch'])
+
+            self.start_manager()
 
             # Get commit ID
             commit = message.get('commit', None)
@@ -243,65 +731,37 @@ class POSClient(WebSocketClient, Debugger):
                     self.debug("Setting COMMIT to: {}".format(commit), color="cyan")
                     with open("commit.dat", "w") as F:
                         F.write(commit)
+                    POSClient.identity = None
 
-                    # Pull changes
-                    cmd = "git show --format='%H' --no-patch"   # Long HASH
-                    status, output = getstatusoutput(cmd)
-                    if status:
-                        lastcommit = output
-                    else:
-                        lastcommit = None
-
-                    if commit != lastcommit:
-                        status, output = getstatusoutput("git fetch origin")
-                        if status:
-                            self.error("Couldn't fetch changes from REPOSITORY, I won't try any MERGE!")
-                        else:
-                            if commit == 'LATEST':
-                                extraarg = ''
-                            else:
-                                extraarg = ' '+commit
-                            status, output = getstatusoutput("git merge{}".format(extraarg))
-                            if status:
-                                self.error("Couldn't merge changes!")
+                    # Update in background (it will restart us when it is done)
+                    self.manager.send_to_updater({'commit': commit}, ref)
 
             else:
                 # Delete commit.dat
                 self.warning("This client is not linked to GITHUB")
                 if os.path.exists("commit.dat"):
                     os.unlink("commit.dat")
-
-            # Configure hardware
-            self.debug("Setting configuration", color='blue')
-
-            error = False
-            for hw in message.get('hardware', []):
-                # Get details
-                uuidtxt = hw.get('uuid', None)
-                kind = hw.get('kind', '')
-                config = hw.get('config', {})
-
-                if uuidtxt is not None:
-                    uid = uuid.UUID(uuidtxt)
-                    if not self.manager.exists_worker(uid):
-                        self.debug("    > Configuring ", color='yellow', tail=False)
-                        self.debug(str(uid), color='purple', head=False, tail=False)
-                        self.debug(" as ", color='yellow', head=False, tail=False)
-                        if kind in self.AVAILABLE_HARDWARE:
-                            self.debug(kind, color='white', head=False)
-                            try:
-                                self.manager.attach(self.AVAILABLE_HARDWARE.get(kind)(uid, config))
-                            except HardwareError as e:
-                                self.send_error("Device {} as {} is wrong configured: {}".format(uid, kind, e), ref, uid)
-                                error = True
-                        else:
-                            self.debug("{}??? - Not setting it up!".format(kind), color='red', head=False)
-                else:
-                    self.error("    > I found a hardware configuration without UUID, I will not set it up!")
+                    POSClient.identity = None
+
+            # Configure hardware (nothing to do if we are already running this configuration)
+            hardware = message.get('hardware', [])
+            signature = self.config_signature(hardware)
+            if signature == POSClient.config_applied:
+                self.debug("Configuration didn't change", color='blue')
+                error = False
+            else:
+                self.debug("Setting configuration", color='blue')
+                error = self.configure_hardware(hardware, ref)
+                if not error:
+                    POSClient.config_applied = signature
+                    self.save_config(hardware)
 
             # Make sure all tasks in manager are running
             self.manager.run(self)
 
+            # Send what was left from a previous connection
+            self.replay()
+
             # If some error during startup
             if error:
                 self.error("I have detected some error, I will try to reconfigure system when next message arrives!")
@@ -309,6 +769,7 @@ class POSClient(WebSocketClient, Debugger):
                 # No error happened, we are ready to go
                 self.debug("Everything is set up and ready to work", color='green')
                 self.__fully_configured = True
+                self.__wakeup.set()
 
         elif action == 'reset':
             self.warning("Got Reset request from Server")
@@ -317,7 +778,7 @@ class POSClient(WebSocketClient, Debugger):
             msg = message.get('message', None)
             uid = message.get('uuid', None)
             if msg and uid:
-                error = self.manager.recv(msg, ref, uid)
+                error = self.manager.recv(msg, ref, uid, message.get('priority', None))
                 if error:
                     self.send_error(error, ref)
             elif msg:
@@ -326,6 +787,10 @@ class POSClient(WebSocketClient, Debugger):
                 self.send_error("Got message for '{}' with no content", ref)
             else:
                 self.send_error("Missing message and destination for your message", ref)
+        elif action == 'batch':
+            # Several messages in one
+            for subquery in message.get('messages', []):
+                self.received_query(subquery)
         elif action == 'error':
             self.error("Got an error from server: {}".format(message.get('error', 'No error')))
         elif action == 'ping':
@@ -335,9 +800,21 @@ class POSClient(WebSocketClient, Debugger):
         elif action != 'config':
             self.send_error("Unknown action '{}'".format(action), ref)
 
-        if action != 'config' and not self.__fully_configured:
+        if action not in ('config', 'batch') and not self.__fully_configured:
             self.debug("Reconfigure system", color='yellow')
-            self.send({'action': 'get_config'}, ref)
+            self.send(self.get_config_message(), ref)
+
+
+def reconnect_delay(attempt):
+    '''
+    Seconds to wait before a reconnection: the first one is immediate, then
+    exponential backoff with jitter so all clients don't come back at once
+    '''
+    if attempt:
+        delay = min(POSClient.RECONNECT_BACKOFF_MAX, POSClient.RECONNECT_BACKOFF * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+    else:
+        return 0
 
 
 def launcher(efc):
@@ -347,6 +824,10 @@ def launcher(efc):
     keepworking = True
     DEBUG = getattr(config, 'DEBUG', False)
     url = "ws://{}/codenerix_pos/?session_key={}".format(config.SERVER, uuid.uuid4().hex)
+    attempt = 0         # Reconnections since we were ready for the last time
+    lost = None         # When we lost the connection
+    warm = True         # Start with the cached configuration
+    ws = None
     while keepworking and efc.keepworking:
         # No connected and no shutdown function
         connected = False
@@ -360,9 +841,17 @@ def launcher(efc):
             print(" \\------------------/")
             print()
 
+        # Bring up devices from the last configuration while we connect
+        if warm:
+            warm = False
+            try:
+                ws.warm_start()
+            except Exception as e:
+                ws.error("Warm start failed, waiting for the server configuration: {}".format(e))
+
         # Connect
         try:
-            timeout2(ws.connect, ws.CONNECT_TIMEOUT, ws.close)
+            timeout2(ws.connect, ws.CONNECT_TIMEOUT, ws.abort_connect)
             connected = True
             ws.debug("Connected to {}".format(url), color='green')
         except TimedOutException:
@@ -386,35 +875,29 @@ def launcher(efc):
             # Add access to external flow controller so it can shutdown WS
             efc.shutdown = ws.shutdown_external
 
-            # Quick wait for configuration (10 seconds) - Gives time the system to startup and request configuration
-            tries = 10
-            while (not ws.client_terminated) and (not ws.manager.isrunning) and tries:
-                time.sleep(1)
-                tries -= 1
+            # Wait for configuration (10 seconds) - Gives time the system to startup and request configuration
+            ready = ws.wait_configured(10)
 
-            # Check if we are not set yet and request configuration until ready
-            if (not ws.client_terminated) and (not ws.manager.isrunning):
-                # Wait until server is ready (50 seconds)
-                tries = 5
-                if (not ws.client_terminated) and (not ws.manager.isrunning) and tries:
-                    # We didn't get configuration yet, request configuration again
-                    ws.debug("Sending reminder for get_config", color="cyan")
-                    try:
-                        ws.configure()
-                    except Exception:
-                        break
-                    # Wait again
-                    ws.debug("Waiting for configuration", color="white")
-                    # One try less
-                    tries -= 1
-                    # Sleep 10 seconds
-                    wait = 10
-                    while (not ws.client_terminated) and wait:
-                        wait -= 1
-                        time.sleep(1)
+            # Request configuration again until ready (5 more times, 10 seconds each)
+            tries = 5
+            while (not ready) and (not ws.client_terminated) and tries:
+                ws.debug("Sending reminder for get_config", color="cyan")
+                try:
+                    ws.configure()
+                except Exception:
+                    break
+                ws.debug("Waiting for configuration", color="white")
+                tries -= 1
+                ready = ws.wait_configured(10)
 
             # Check if we are set
-            if (not ws.client_terminated) and ws.manager.isrunning:
+            if ready and (not ws.client_terminated):
+                # We are back
+                attempt = 0
+                if lost is not None:
+                    ws.debug("Ready {:.3f} seconds after losing the connection".format(time.monotonic() - lost), color='green')
+                    lost = None
+
                 # Wait forever
                 try:
                     ws.run_forever()
@@ -423,37 +906,70 @@ def launcher(efc):
                     ws.debug("")
                     ws.debug("User requested to exit", color='yellow')
                     ws.debug("")
-                finally:
-                    try:
-                        ws.shutdown()
-                    except Exception:
-                        pass
-                    try:
-                        ws.close()
-                    except Exception:
-                        pass
-            else:
-                try:
-                    ws.shutdown()
-                except Exception:
-                    pass
-                try:
-                    ws.close()
-                except Exception:
-                    pass
+
+            # Close this connection, workers keep running for the next one
+            try:
+                ws.close()
+            except Exception:
+                pass
 
         if keepworking and efc.keepworking:
-            ws.warning("Detected disconnection from server: reconnecting WebSocket in 5 seconds!")
+            if lost is None:
+                lost = time.monotonic()
+            delay = reconnect_delay(attempt)
+            attempt += 1
+            ws.warning("Detected disconnection from server: reconnecting WebSocket in {:.1f} seconds!".format(delay))
             try:
-                time.sleep(5)
+                time.sleep(delay)
             except KeyboardInterrupt:
                 keepworking = False
                 ws.debug("")
                 ws.debug("User requested to exit", color='yellow')
                 ws.debug("")
 
+    # We are leaving, stop all workers
+    if ws is not None:
+        try:
+            ws.shutdown()
+        except Exception:
+            pass
+
+
+def benchmark(rounds=2000):
+    '''
+    Decoding cost per frame in received_message for every kind of frame
+    '''
+
+    class Package:
+        def __init__(self, data, is_binary=False):
+            self.data = data
+            self.is_binary = is_binary
+
+    ws = POSClient("ws://{}/codenerix_pos/".format(config.SERVER))
+    ws.set_debug({})
+    ws.recv = lambda request, ref: None
+    ws.manager = type("DummyManager", (), {'send_to_watchdog': lambda self, msg, ref: None, 'alive': lambda self: None})()
+
+    # A typical config request
+    request = codec.dumps({'request': {'action': 'config', 'hardware': [{'uuid': uuid.uuid4().hex, 'kind': 'TICKET', 'config': {'port': '/dev/usb/lp0'}}] * 4}, 'ref': '1'})
+    header = ws.frame_header()
+    packages = {
+        'plain': Package(codec.dumps({'message': codec.dumps({'action': 'pongdog', 'ref': '1'})}).encode('utf-8')),
+        'cbc': Package(codec.dumps({'message': ws.crypto.encrypt(request, config.KEY).decode('utf-8')}).encode('utf-8')),
+        'gcm': Package(header + ws.crypto.encrypt_gcm(request.encode('utf-8'), config.KEY, header), True),
+    }
+    for (kind, package) in packages.items():
+        start = time.perf_counter()
+        for i in range(rounds):
+            ws.received_message(package)
+        print("{:>6}: {:8.1f} us/frame".format(kind, (time.perf_counter() - start) / rounds * 1e6))
+
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+        sys.exit(0)
+
     class ExternalFlowController:
         '''
         Dummy External Flow Controller
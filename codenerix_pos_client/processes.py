@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-pos-client
+#
+# Copyright 2017 Juanmi Taboada - http://www.juanmitaboada.com
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import pickle
+import struct
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+from workers import POSWorker, POSQueue, Envelope, POSQueueFull, WAKEUP
+from hardware import HardwareError
+
+
+class SharedRing(object):
+    '''
+    Ring buffer living in shared memory which moves frames in one direction
+    between two processes. The header keeps the read and write counters and
+    the closed flag, every frame is prefixed with its length. Waiting is done
+    on semaphores so a process dying on the other side can not block us.
+    '''
+
+    HEADER = struct.Struct('QQQ')   # Read counter, write counter, closed
+    LENGTH = struct.Struct('I')
+
+    def __init__(self, size=1 << 20, context=None):
+        if context is None:
+            context = multiprocessing.get_context()
+        self.__shm = shared_memory.SharedMemory(create=True, size=self.HEADER.size + size)
+        self.__owner = True
+        self.__capacity = size
+        self.__lock = context.Lock()
+        self.__readable = context.Semaphore(0)
+        self.__writable = context.Semaphore(0)
+        self.HEADER.pack_into(self.__shm.buf, 0, 0, 0, 0)
+
+    def __getstate__(self):
+        # Only sent to the child process while it is being spawned
+        return (self.__shm.name, self.__capacity, self.__lock, self.__readable, self.__writable)
+
+    def __setstate__(self, state):
+        (name, self.__capacity, self.__lock, self.__readable, self.__writable) = state
+        self.__shm = shared_memory.SharedMemory(name=name)
+        self.__owner = False
+
+    def __header(self):
+        return self.HEADER.unpack_from(self.__shm.buf, 0)
+
+    def __copy_in(self, position, data):
+        start = position % self.__capacity
+        first = min(len(data), self.__capacity - start)
+        base = self.HEADER.size
+        self.__shm.buf[base + start:base + start + first] = data[:first]
+        if first < len(data):
+            self.__shm.buf[base:base + len(data) - first] = data[first:]
+
+    def __copy_out(self, position, size):
+        start = position % self.__capacity
+        first = min(size, self.__capacity - start)
+        base = self.HEADER.size
+        data = bytes(self.__shm.buf[base + start:base + start + first])
+        if first < size:
+            data += bytes(self.__shm.buf[base:base + size - first])
+        return data
+
+    @staticmethod
+    def __remaining(deadline):
+        if deadline is None:
+            return None
+        else:
+            return max(0, deadline - time.monotonic())
+
+    @property
+    def closed(self):
+        return bool(self.__header()[2])
+
+    def write(self, data, timeout=None):
+        frame = self.LENGTH.pack(len(data)) + data
+        if len(frame) > self.__capacity:
+            raise POSQueueFull("Frame of {} bytes does not fit in a ring of {} bytes".format(len(frame), self.__capacity))
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                (head, tail, closed) = self.__header()
+                if closed:
+                    return
+                elif self.__capacity - (tail - head) >= len(frame):
+                    self.__copy_in(tail, frame)
+                    self.HEADER.pack_into(self.__shm.buf, 0, head, tail + len(frame), closed)
+                    self.__readable.release()
+                    return
+
+            # Wait for the reader to make some room
+            if not self.__writable.acquire(True, self.__remaining(deadline)):
+                raise POSQueueFull("Ring is still full after {} seconds".format(timeout))
+
+    def read(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__lock:
+                (head, tail, closed) = self.__header()
+                if tail > head:
+                    (size, ) = self.LENGTH.unpack(self.__copy_out(head, self.LENGTH.size))
+                    data = self.__copy_out(head + self.LENGTH.size, size)
+                    self.HEADER.pack_into(self.__shm.buf, 0, head + self.LENGTH.size + size, tail, closed)
+                    self.__writable.release()
+                    return data
+                elif closed:
+                    return None
+
+            # Wait for the writer to send something
+            if not self.__readable.acquire(True, self.__remaining(deadline)):
+                return None
+
+    def close(self):
+        with self.__lock:
+            (head, tail, closed) = self.__header()
+            self.HEADER.pack_into(self.__shm.buf, 0, head, tail, 1)
+        # Wake up anybody waiting on us
+        self.__readable.release()
+        self.__writable.release()
+
+    def release(self):
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
+
+
+class RingRoute(POSQueue):
+    '''
+    Queue seen by the isolated worker for somebody living in the main process,
+    everything put here travels through the outbound ring
+    '''
+
+    def __init__(self, ring, uidhex):
+        super(RingRoute, self).__init__()
+        self.__ring = ring
+        self.__uidhex = uidhex
+
+    def put(self, item, block=True, timeout=None, lane=None):
+        if lane is None:
+            lane = self.DEFAULT_LANE
+        if not block:
+            # Fail at once if there is no room
+            timeout = 0
+        elif timeout is None:
+            timeout = self.timeout
+        self.__ring.write(pickle.dumps((self.__uidhex, item.uid, item.msg, item.ref, lane)), timeout)
+
+
+def isolated_main(cls, uid, config, inbound, outbound):
+    '''
+    Entry point of the child process: build the real worker, tell the main
+    process how it went and feed the worker from the inbound ring
+    '''
+
+    # Build the worker
+    try:
+        worker = cls(uid, config)
+    except Exception as e:
+        outbound.write(pickle.dumps(('failed', str(e))))
+        inbound.release()
+        outbound.release()
+        return
+    outbound.write(pickle.dumps(('ready', None)))
+
+    # Wait until the main process starts us and link with our parent
+    data = inbound.read()
+    if data is None:
+        inbound.release()
+        outbound.release()
+        return
+    parenthex = pickle.loads(data)
+    worker.parent(parenthex, RingRoute(outbound, parenthex))
+
+    def pump():
+        while not worker.stoprequest.isSet():
+            data = inbound.read(1)
+            if data is None:
+                if inbound.closed:
+                    # Main process asked us to stop
+                    worker.stoprequest.set()
+                    worker.wakeup()
+                continue
+
+            # Make sure we know the way back to the sender
+            (source, msg, ref, lane) = pickle.loads(data)
+            if source not in worker.registry:
+                worker.registry.register(source, RingRoute(outbound, source))
+
+            # Deliver to the worker
+            try:
+                worker.mailbox.put(Envelope(source, msg, ref), lane=lane)
+            except POSQueueFull as e:
+                worker.error("Message from {} dropped: {}".format(source, e))
+
+    # Start pumping messages and run the worker in our main thread
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+    try:
+        worker.run()
+    finally:
+        worker.stoprequest.set()
+        inbound.release()
+        outbound.release()
+
+
+class RasterWorker(POSWorker):
+    '''
+    Stand-in for a ticket printer used by the benchmark below: it turns a
+    grayscale image into printer rows in pure Python, holding the GIL meanwhile
+    '''
+
+    def recv(self, msg, ref, uid=None):
+        (width, height) = msg['size']
+        pixels = msg['image']
+        rows = []
+        for y in range(height):
+            row = bytearray(width // 8)
+            base = y * width
+            for x in range(width):
+                if pixels[base + x] < 128:
+                    row[x >> 3] |= 0x80 >> (x & 7)
+            rows.append(bytes(row))
+        self.send({'ack': True, 'rows': len(rows)}, ref, uid)
+
+
+class POSProcessWorker(POSWorker):
+    '''
+    Host a worker in a child process so CPU heavy drivers do not hold our GIL,
+    this proxy takes its place in the bus and is the one moving messages
+    through the shared memory rings. If the child dies it gets restarted.
+    The child is spawned when the proxy is built, so a worker that can not be
+    built (wrong configuration, missing driver) raises HardwareError right there.
+    '''
+
+    ring_size = 1 << 20     # Bytes of each ring
+    start_timeout = 30      # Seconds the child has to build the worker
+    stop_timeout = 5        # Seconds the child has to stop before we terminate it
+    max_backoff = 60        # Maximum seconds between restarts
+
+    def __init__(self, cls, uid, config):
+        # Look like the hosted worker in the bus
+        self.__cls = cls
+        self.__hosted_config = config
+        self.module_name = cls.module_name
+        self.queue_size = cls.queue_size
+        self.queue_policy = cls.queue_policy
+        self.queue_timeout = cls.queue_timeout
+        self.priority = cls.priority
+        self.durable = cls.durable
+
+        # Child process details
+        self.__context = multiprocessing.get_context('spawn')
+        self.__process = None
+        self.__inbound = None
+        self.__outbound = None
+        self.__reader = None
+        self.restarts = 0
+
+        # Build the worker before we take its place in the bus
+        self.__spawn(uid)
+
+        # Let the constructor to finish the job
+        super(POSProcessWorker, self).__init__(uid, config)
+
+    def __spawn(self, uid):
+        # Start the child and wait until it tells us how building the worker went
+        self.__inbound = SharedRing(self.ring_size, self.__context)
+        self.__outbound = SharedRing(self.ring_size, self.__context)
+        self.__process = self.__context.Process(
+            target=isolated_main,
+            args=(self.__cls, uid, self.__hosted_config, self.__inbound, self.__outbound),
+            daemon=True,
+        )
+        self.__process.start()
+
+        data = None
+        deadline = time.monotonic() + self.start_timeout
+        while data is None and self.__process.is_alive() and time.monotonic() < deadline:
+            data = self.__outbound.read(0.5)
+        if data is None:
+            data = self.__outbound.read(0)
+        if data is None:
+            (status, error) = ('failed', "Isolated worker didn't start (exitcode {})".format(self.__process.exitcode))
+        else:
+            (status, error) = pickle.loads(data)
+
+        if status != 'ready':
+            self.__reap()
+            raise HardwareError(error)
+
+    def __launch(self):
+        # Link the child with its parent and start moving its messages
+        self.__inbound.write(pickle.dumps(self.parentuuid))
+        self.__reader = threading.Thread(target=self.__read, args=(self.__outbound, ), daemon=True)
+        self.__reader.start()
+        self.debug("Isolated worker started with PID {}".format(self.__process.pid), color='blue')
+
+    def __reap(self):
+        # Stop the child and release the rings
+        self.__inbound.close()
+        self.__process.join(self.stop_timeout)
+        if self.__process.is_alive():
+            self.__process.terminate()
+            self.__process.join()
+        self.__outbound.close()
+        if self.__reader is not None:
+            self.__reader.join()
+            self.__reader = None
+        self.__inbound.release()
+        self.__outbound.release()
+        self.__process = None
+
+    def __read(self, ring):
+        # Deliver to the main process everything the child sends
+        while not ring.closed:
+            data = ring.read(1)
+            if data is not None:
+                (target, source, msg, ref, lane) = pickle.loads(data)
+                queue = self.get_queue(target)
+                if queue is not None:
+                    try:
+                        queue.put(Envelope(source, msg, ref), lane=lane)
+                    except POSQueueFull as e:
+                        self.error("Message to {} dropped: {}".format(target, e))
+                else:
+                    self.warning("Isolated worker tried to send to unknown UUID '{}'".format(target))
+
+    def run(self):
+        if self.__process is not None:
+            self.__launch()
+
+        # Keep running until master say to stop
+        while not self.stoprequest.isSet():
+
+            # Forward messages to the child in the lane they came
+            for (lane, envelope) in self.mailbox.get_many(self.batch_size, True, 1, lanes=True):
+                if envelope is WAKEUP:
+                    continue
+                try:
+                    self.__inbound.write(pickle.dumps((envelope.uid, envelope.msg, envelope.ref, lane)), self.queue_timeout)
+                except POSQueueFull as e:
+                    self.send({'error': "Isolated worker is overloaded: {}".format(e)}, envelope.ref, envelope.uid)
+
+            # Supervise the child
+            if (self.__process is None or not self.__process.is_alive()) and not self.stoprequest.isSet():
+                if self.__process is not None:
+                    self.error("Isolated worker died (exitcode {})".format(self.__process.exitcode))
+                    try:
+                        self.send({'error': "Isolated worker died, restarting it"}, None)
+                    except POSQueueFull:
+                        pass
+                    self.__reap()
+                self.restarts += 1
+                wait = min(2 ** self.restarts, self.max_backoff)
+                self.warning("Restarting isolated worker in {} seconds".format(wait))
+                if not self.stoprequest.wait(wait):
+                    try:
+                        self.__spawn(self.uuid)
+                        self.__launch()
+                    except HardwareError as e:
+                        self.error("Isolated worker couldn't be restarted: {}".format(e))
+                        try:
+                            self.send({'error': "Isolated worker couldn't be restarted: {}".format(e)}, None)
+                        except POSQueueFull:
+                            pass
+
+        # Stop the child
+        if self.__process is not None:
+            self.__reap()
+        self.debug("Isolated worker is down", color='green')
+
+    def join(self, timeout=None):
+        # Never started, the child is still waiting for us
+        if self.ident is None and self.__process is not None:
+            self.__reap()
+        super(POSProcessWorker, self).join(timeout)
+
+
+if __name__ == '__main__':
+    # Heartbeat jitter in the main process while a worker prints image-heavy tickets, threaded against isolated
+    import uuid
+    import random
+
+    beat = 0.02
+    seconds = 10
+    size = (576, 400)
+    image = bytes(random.randint(0, 255) for i in range(size[0] * size[1]))
+
+    def heartbeat(stop, lateness):
+        # Like the Watchdog: wake up on schedule and write down how late we were
+        scheduled = time.monotonic() + beat
+        while not stop.wait(max(0, scheduled - time.monotonic())):
+            lateness.append(time.monotonic() - scheduled)
+            scheduled += beat
+
+    for mode in ('thread', 'process'):
+        uid = uuid.uuid4()
+        back = POSQueue(10)
+        POSWorker.registry.register('benchmark', back)
+        if mode == 'thread':
+            worker = RasterWorker(uid, {})
+        else:
+            worker = POSProcessWorker(RasterWorker, uid, {})
+        worker.parent('benchmark', back)
+        worker.start()
+
+        stop = threading.Event()
+        lateness = []
+        beater = threading.Thread(target=heartbeat, args=(stop, lateness))
+        beater.start()
+
+        # Print tickets back to back
+        tickets = 0
+        finish = time.monotonic() + seconds
+        while time.monotonic() < finish:
+            POSWorker.registry.get_queue(uid.hex).put(Envelope('benchmark', {'size': size, 'image': image}, tickets))
+            back.get(True, 30)
+            tickets += 1
+
+        stop.set()
+        beater.join()
+        worker.join(10)
+
+        lateness.sort()
+        print("{:>7}: {} tickets - heartbeat late p50 {:.2f} ms - p99 {:.2f} ms - max {:.2f} ms".format(
+            mode,
+            tickets,
+            lateness[len(lateness) // 2] * 1000,
+            lateness[int(len(lateness) * 0.99)] * 1000,
+            lateness[-1] * 1000,
+        ))
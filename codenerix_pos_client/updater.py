@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-pos-client
+#
+# Copyright 2017 Juanmi Taboada - http://www.juanmitaboada.com
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from workers import POSWorker
+
+
+class Updater(POSWorker):
+    '''
+    Brings the client to the commit the server asks for without blocking
+    anybody: fetch it, check it in a separate worktree, wait until the
+    devices are quiet, fast-forward and ask for a restart. Every step is
+    reported to the server as a message from this worker.
+    '''
+
+    module_name = "Updater"
+    loop_tick = 5
+    queue_policy = 'latest'     # Only the last commit requested matters
+    priority = 'bulk'
+    quiet_after = 30            # Seconds without traffic to the devices before applying an update
+    git_timeout = 300           # Seconds a git command may take
+
+    def __init__(self, uid, name, idle):
+        '''
+        idle: function returning the seconds since the devices got their last message
+        '''
+
+        self.__idle = idle
+        self.__wanted = None    # (commit, ref) requested by the server
+        self.__staged = None    # (target, ref, commit, started, timing) ready to be applied
+
+        # Let the constructor to finish the job
+        super(Updater, self).__init__(uid, {'name': name})
+
+    def git(self, *args):
+        # Run git without a shell (commits come from the network), return (status, output)
+        try:
+            result = subprocess.run(("git", ) + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=self.git_timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return (-1, str(e))
+        return (result.returncode, result.stdout.strip())
+
+    def report(self, step, ref, commit, started, **kwargs):
+        # Tell the server how it goes
+        kwargs.update({'update': step, 'commit': commit, 'seconds': round(time.monotonic() - started, 3)})
+        self.debug("Update {}: {}".format(commit, step), color='cyan')
+        self.send(kwargs, ref)
+
+    def recv(self, msg, ref, uid=None):
+        if isinstance(msg, dict) and 'commit' in msg:
+            # Work on it in the next loop
+            self.__wanted = (msg['commit'], ref)
+        else:
+            super(Updater, self).recv(msg, ref, uid)
+
+    def loop(self):
+        if self.__wanted is not None:
+            (commit, ref) = self.__wanted
+            self.__wanted = None
+            self.stage(commit, ref)
+
+        if self.__staged is not None and self.__idle() >= self.quiet_after:
+            self.apply()
+
+    def stage(self, commit, ref):
+        started = time.monotonic()
+        timing = {}
+
+        # Fetch
+        self.report('fetching', ref, commit, started)
+        (status, output) = self.git("fetch", "origin")
+        if status:
+            self.report('error', ref, commit, started, error="Couldn't fetch changes from REPOSITORY: {}".format(output))
+            return
+        timing['fetch'] = round(time.monotonic() - started, 3)
+
+        # Find out where we should go
+        if commit == 'LATEST':
+            (status, target) = self.git("rev-parse", "--verify", "@{u}")
+        else:
+            (status, target) = self.git("rev-parse", "--verify", "{}^{{commit}}".format(commit))
+        if status:
+            self.report('error', ref, commit, started, error="Commit not found: {}".format(target))
+            return
+        (status, head) = self.git("rev-parse", "HEAD")
+        if not status and head == target:
+            self.__staged = None
+            self.report('updated', ref, commit, started)
+            return
+        (status, output) = self.git("merge-base", "--is-ancestor", "HEAD", target)
+        if status:
+            self.report('error', ref, commit, started, error="Commit {} can not be reached with a fast-forward".format(target))
+            return
+
+        # Verify it in its own worktree (the running tree is not touched)
+        self.report('verifying', ref, commit, started)
+        path = tempfile.mkdtemp(prefix="codenerix_pos_client_update_")
+        try:
+            (status, output) = self.git("worktree", "add", "--detach", path, target)
+            if not status:
+                try:
+                    result = subprocess.run((sys.executable, "-m", "compileall", "-q", path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=self.git_timeout)
+                    (status, output) = (result.returncode, result.stdout.strip())
+                except (OSError, subprocess.TimeoutExpired) as e:
+                    (status, output) = (-1, str(e))
+        finally:
+            self.git("worktree", "remove", "--force", path)
+            shutil.rmtree(path, ignore_errors=True)
+        if status:
+            self.report('error', ref, commit, started, error="Commit {} didn't pass verification: {}".format(target, output))
+            return
+        timing['verify'] = round(time.monotonic() - started, 3)
+
+        # Ready, wait for a quiet moment
+        self.__staged = (target, ref, commit, started, timing)
+        self.report('staged', ref, commit, started, target=target, timing=dict(timing))
+
+    def apply(self):
+        (target, ref, commit, started, timing) = self.__staged
+        self.__staged = None
+
+        self.report('applying', ref, commit, started, target=target)
+        (status, output) = self.git("merge", "--ff-only", target)
+        if status:
+            self.report('error', ref, commit, started, error="Couldn't merge changes: {}".format(output))
+            return
+        timing['apply'] = round(time.monotonic() - started, 3)
+
+        # Run the new version
+        self.report('restarting', ref, commit, started, target=target, timing=dict(timing))
+        self.send("restart", ref)
@@ -20,100 +20,185 @@
 # limitations under the License.
 
 import time
-import datetime
 
-from workers import POSWorker
-
-
-class Watchdog(POSWorker):
-
-    hearbeat_rate = 6   # Beats per minute
-    hurted_after = 25   # Hurted after 25 seconds
-    dead_after = 60     # Shutdown after 60 seconds
-    last_beat = None    # No last beat
-    suicides = 0        # Times we have tried to suicide
-
-    def __init__(self, uid, name, posclient):
-
-        # POSClient object
-        self.__posclient = posclient
+from asyncworkers import AsyncPOSWorker
+
+
+class RTTHistogram(object):
+    '''
+    Round trip times kept in log2 buckets of milliseconds (bucket i counts
+    times below 2^i ms), enough for percentiles with a few integers
+    '''
+
+    BUCKETS = 20    # Up to ~9 minutes
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.last = None
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, rtt):
+        ms = rtt * 1000
+        self.buckets[min(self.BUCKETS - 1, int(ms).bit_length())] += 1
+        self.count += 1
+        self.last = ms
+        self.minimum = ms if self.minimum is None else min(self.minimum, ms)
+        self.maximum = ms if self.maximum is None else max(self.maximum, ms)
+
+    def percentile(self, p):
+        # Upper bound of the bucket where the percentile falls (never above the maximum)
+        if not self.count:
+            return None
+        wanted = p / 100 * self.count
+        seen = 0
+        for (bucket, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(float(1 << bucket), self.maximum)
+        return self.maximum
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'last': self.last,
+            'min': self.minimum,
+            'max': self.maximum,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Watchdog(AsyncPOSWorker):
+    '''
+    Heartbeat with the server, it lives as a task in the asyncio runtime since
+    it spends most of its life waiting
+    '''
+
+    hearbeat_rate = 6           # Beats per minute when nothing else tells us the server is there
+    quiet_rate = 3              # Beats per minute while traffic from the server proves it is alive
+    hurted_rate = 30            # Beats per minute while hurted
+    hurted_after = 25           # Hurted after 25 seconds
+    dead_after = 60             # Shutdown after 60 seconds
+    report_every = 6            # Beats between RTT reports in the log
+    last_beat = None            # No last beat
+    suicides = 0                # Times we have tried to suicide
+    queue_size = 16
+    queue_policy = 'drop_oldest'    # Only recent beats matter
+    priority = 'control'        # Our orders go before anything else
+
+    def __init__(self, uid, name, alive=None):
+        '''
+        alive: function returning when (time.monotonic()) the server sent us something for the last time
+        '''
+
+        self.__alive = alive
+        self.__sequence = 0
+        self.__pending = {}     # Beats waiting for answer: sequence -> when they were sent
+        self.rtt = RTTHistogram()
 
         # Let the constructor to finish the job
         super(Watchdog, self).__init__(uid, {'name': name})
 
-    def run(self):
+    def rtt_stats(self):
+        return self.rtt.stats()
+
+    def reset(self):
+        # Forget what happened on the connection before (beats, suicides and RTT)
+        self.last_beat = time.monotonic()
+        self.suicides = 0
+        self.__pending = {}
+        self.rtt = RTTHistogram()
+
+    def pong(self, ref, arrived):
+        # Answer to one of our beats (arrived is when it reached the client)
+        try:
+            sequence = int(ref)
+        except (TypeError, ValueError):
+            return
+        sent = self.__pending.pop(sequence, None)
+        if sent is not None:
+            self.rtt.add(max(0, arrived - sent))
+            self.last_beat = max(self.last_beat, sent)
+
+    async def run(self):
 
         # Set up
         self.debug("Starting Watchdog", color='blue')
 
-        # We start with no beats
-        beats = 0
-
-        # Last beat is now
-        self.last_beat = datetime.datetime.now()
+        # Last beat is now, next one right away
+        self.last_beat = time.monotonic()
+        next_beat = self.last_beat
 
         # While we should keep working
         while not self.stoprequest.isSet():
-            if beats:
-                # One beat less
-                beats -= 1
-            else:
-                # Say the system we are doing a heartbeat
-                # self.debug("Heartbeat cycle", color='white')
-                if self.suicides:
-                    self.warning("I have tried to suicide {} times, can you imagine how difficult is to live like this? O_O".format(self.suicides))
 
-                # Get timestamp
-                now = datetime.datetime.now()
-
-                # Reset beats
-                beats = 60 / self.hearbeat_rate
-
-                # Get the last message from the buffer
-                package = None
-                tmppackage = self.get()
-                while tmppackage:
-                    package = tmppackage
-                    tmppackage = self.get()
-
-                # If we got some package
-                if package:
-                    (source, msg, ref) = package
-                    # self.debug("Watchdog MSG: {} (REF:{})".format(msg, ref), color='purple')
-
-                    # Check last beat
-                    try:
-                        refdate = datetime.datetime.strptime(ref, '%Y-%m-%d %H:%M:%S.%f')
-                    except Exception:
-                        refdate = 0
-                    self.last_beat = max(self.last_beat, refdate)
-
-                # Check distance from reality
-                distance = datetime.datetime.now() - self.last_beat
-                if distance.seconds > self.dead_after:
-                    # It has passed too much time since last confirmed beat, we are dead! :-(
-                    self.warning("Getting a ticket to /dev/null, trash or wherever processes are gone when we die. Good bye world! :-(")
-                    self.suicides += 1
-                    if self.suicides > 2:
-                        self.send("terminate", str(datetime.datetime.now()))
-                    else:
-                        self.send("close", str(datetime.datetime.now()))
-                    # Wait 10 seconds for the system to die
-                    tries = 10
-                    while tries and (not self.stoprequest.isSet()):
-                        tries -= 1
-                        time.sleep(1)
-                    continue
-                elif distance.seconds > self.hurted_after:
-                    self.warning("I have been hurted, it has passed {} seconds already and I didn't get answer from the main thread, maybe is locked? (Waiting {} seconds more)".format(distance.seconds, self.dead_after-distance.seconds))
+            # Wait until the next beat (checking at least once a second), answers to
+            # our beats are taken as soon as they arrive
+            packages = await self.get_many(None, min(1, max(0, next_beat - time.monotonic())))
+            self.woken()
+            now = time.monotonic()
+
+            # Collect answers to our beats
+            for (source, msg, ref) in packages:
+                if isinstance(msg, dict) and 'pongdog' in msg:
+                    self.pong(ref, msg['pongdog'])
+                elif msg == 'reset':
+                    self.debug("Connection is new, starting again", color='blue')
+                    self.reset()
+                    next_beat = now
+
+            # Any message from the server proves it is alive as well as a beat
+            alive = self.__alive() if self.__alive else None
+            if alive is not None:
+                self.last_beat = max(self.last_beat, alive)
+
+            # Check distance from reality
+            distance = now - self.last_beat
+            if distance > self.dead_after:
+                # It has passed too much time since last confirmed beat, we are dead! :-(
+                self.warning("Getting a ticket to /dev/null, trash or wherever processes are gone when we die. Good bye world! :-(")
+                self.suicides += 1
+                if self.suicides > 2:
+                    await self.send("terminate", None)
                 else:
-                    # Nothing to do, send another pingdog
-                    # self.debug("Heartbeat - {}".format(now), color='white')
-                    if not self.stoprequest.isSet():
-                        self.__posclient.send({'action': 'pingdog'}, str(now))
+                    await self.send("close", None)
+                # Wait 10 seconds for the system to die
+                await self.pause(10)
+                continue
+            hurted = distance > self.hurted_after
+            if hurted:
+                rate = self.hurted_rate
+            elif alive is not None and now - alive < 60 / self.hearbeat_rate:
+                # Traffic is telling us the server is there, beat slower
+                rate = self.quiet_rate
+            else:
+                rate = self.hearbeat_rate
 
-            # Sleep for a second (1 beat a second)
-            time.sleep(1)
+            # Beat when it is time (a faster rate brings the next beat closer)
+            next_beat = min(next_beat, self.last_beat + 60 / rate)
+            if now >= next_beat:
+                if self.suicides:
+                    self.warning("I have tried to suicide {} times, can you imagine how difficult is to live like this? O_O".format(self.suicides))
+                if hurted:
+                    self.warning("I have been hurted, it has passed {} seconds already and I didn't get answer from the main thread, maybe is locked? (Waiting {} seconds more)".format(int(distance), int(self.dead_after - distance)))
+
+                # Forget beats that will never come back
+                for (sequence, sent) in list(self.__pending.items()):
+                    if now - sent > self.dead_after:
+                        del self.__pending[sequence]
+
+                # Send another pingdog with our RTT so far
+                self.__sequence += 1
+                self.__pending[self.__sequence] = now
+                await self.send({'pingdog': self.__sequence, 'rtt': self.rtt.stats()}, None)
+                next_beat = now + 60 / rate
+
+                if self.report_every and not self.__sequence % self.report_every and self.rtt.count:
+                    stats = self.rtt.stats()
+                    self.debug("Heartbeat RTT: last {:.1f} ms - p50 {:.0f} ms - p90 {:.0f} ms - p99 {:.0f} ms ({} beats)".format(stats['last'], stats['p50'], stats['p90'], stats['p99'], stats['count']), color='white')
 
         # Get back the thread
         self.debug("Watchdog is down...", color='green')
@@ -20,8 +20,6 @@
 # limitations under the License.
 
 import os
-import json
-import time
 import threading
 
 try:
@@ -38,6 +36,7 @@ from tornado.ioloop import IOLoop
 from tornado.web import Application, RequestHandler
 
 from lib.debugger import Debugger
+from lib import codec
 
 from workers import POSWorker
 from config import UUID, URL_HOME, PORT, ALLOWED_IPS, KEY
@@ -65,11 +64,11 @@ class WSHandler(WebSocketHandler, Debugger):
 
     def open(self):
         self.debug('New connection from {}'.format(self.request.remote_ip), color='cyan')
-        self.write_message(json.dumps({'uuid': UUID, 'key': KEY, 'commit': self.commit}))
+        self.write_message(codec.dumps({'uuid': UUID, 'key': KEY, 'commit': self.commit}))
 
     def on_message(self, message):
         self.debug('Message from {}: {}'.format(self.request.remote_ip, message), color='green')
-        self.write_message(json.dumps({'uuid': UUID}))
+        self.write_message(codec.dumps({'uuid': UUID}))
 
     def on_close(self):
         self.debug('Connection closed for {}'.format(self.request.remote_ip), color='cyan')
@@ -121,8 +120,7 @@ class WebServer(POSWorker):
 
         # Keep running until master say to stop
         self.debug("WebServer is up", color='green')
-        while not self.stoprequest.isSet():
-            time.sleep(1)
+        self.stoprequest.wait()
 
         self.debug("Shutting down...", color='blue')
         # Stop server
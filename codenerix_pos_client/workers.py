@@ -18,21 +18,415 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import fnmatch
+import collections
 import time
 import random
 import uuid
-import json
 import queue
+import weakref
 import threading
 
 from lib.debugger import Debugger
 
 
+class Envelope(object):
+    '''
+    Message travelling through the internal bus, it is passed by reference
+    between workers (nobody should modify it once it has been sent)
+    '''
+
+    __slots__ = ('uid', 'msg', 'ref')
+
+    def __init__(self, uid, msg, ref=None):
+        self.uid = uid
+        self.msg = msg
+        self.ref = ref
+
+    def __repr__(self):
+        return "Envelope({}, {}, {})".format(self.uid, self.msg, self.ref)
+
+
+class POSWorkerRegistry(object):
+    '''
+    Directory of the queues registered in the bus, indexed both ways (by UUID
+    and by Queue) so routing never has to scan the whole list of workers
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__queues = {}                                  # UUID -> Queue
+        self.__uuids = {}                                   # Queue -> UUID
+        self.__workers = weakref.WeakValueDictionary()      # UUID -> POSWorker
+
+    def __contains__(self, uidhex):
+        return uidhex in self.__queues
+
+    def __len__(self):
+        return len(self.__queues)
+
+    def register(self, uidhex, queue, worker=None):
+        with self.__lock:
+            # Forget the old queue if this UUID was already registered
+            old = self.__queues.get(uidhex, None)
+            if old is not None:
+                self.__uuids.pop(old, None)
+
+            # Index the queue both ways
+            self.__queues[uidhex] = queue
+            self.__uuids[queue] = uidhex
+
+            # Remember the worker without keeping it alive
+            if worker is not None:
+                self.__workers[uidhex] = worker
+
+        # Unregister automatically once the worker is gone
+        if worker is not None:
+            weakref.finalize(worker, self.unregister, uidhex, queue)
+
+    def unregister(self, uidhex, queue=None):
+        with self.__lock:
+            current = self.__queues.get(uidhex, None)
+            # Do not remove somebody else that registered later with the same UUID
+            if current is not None and (queue is None or current is queue):
+                self.__queues.pop(uidhex)
+                self.__uuids.pop(current, None)
+                self.__workers.pop(uidhex, None)
+
+    def get_queue(self, uidhex):
+        return self.__queues.get(uidhex, None)
+
+    def get_uuid(self, queue):
+        return self.__uuids.get(queue, None)
+
+    def get_worker(self, uidhex):
+        return self.__workers.get(uidhex, None)
+
+    def uuids(self):
+        return list(self.__queues.keys())
+
+
+class POSChannels(object):
+    '''
+    Publish/subscribe system for the workers: subscribers ask for a pattern
+    (wildcards allowed) and get their own ring buffer where the oldest message
+    is dropped when it is full. Publishing hands the same envelope to every
+    subscriber (nothing gets copied).
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__topics = set()
+        self.__subscriptions = {}       # Pattern -> {UUID: POSQueue}
+        self.__owners = {}              # (Pattern, UUID) -> Mailbox of the worker subscribed
+        self.__routes = {}              # Topic -> [POSQueue, ...] (cache)
+
+    def exists(self, name):
+        return name in self.__topics
+
+    def add(self, name):
+        with self.__lock:
+            if name in self.__topics:
+                return False
+            self.__topics.add(name)
+            return True
+
+    def remove(self, name):
+        with self.__lock:
+            if name not in self.__topics:
+                return False
+            self.__topics.remove(name)
+            self.__routes.pop(name, None)
+            return True
+
+    def subscribe(self, uidhex, pattern, size, owner=None):
+        '''
+        Return the new subscription, None if this owner was already subscribed
+        (a different owner with the same UUID, a replacement worker, takes it over)
+        '''
+        with self.__lock:
+            subscribers = self.__subscriptions.setdefault(pattern, {})
+            if uidhex in subscribers and self.__owners.get((pattern, uidhex), None) is owner:
+                return None
+            subscription = POSQueue(size, 'drop_oldest')
+            subscribers[uidhex] = subscription
+            self.__owners[(pattern, uidhex)] = owner
+            self.__routes.clear()
+            return subscription
+
+    def unsubscribe(self, uidhex, pattern, subscription=None):
+        with self.__lock:
+            subscribers = self.__subscriptions.get(pattern, {})
+            current = subscribers.get(uidhex, None)
+            # Do not remove somebody else that subscribed later with the same UUID
+            if current is None or (subscription is not None and current is not subscription):
+                return False
+            subscribers.pop(uidhex)
+            self.__owners.pop((pattern, uidhex), None)
+            if not subscribers:
+                self.__subscriptions.pop(pattern)
+            self.__routes.clear()
+            return True
+
+    def subscription(self, uidhex, pattern, owner=None):
+        # The subscription of that UUID (only if it belongs to the owner given)
+        subscription = self.__subscriptions.get(pattern, {}).get(uidhex, None)
+        if owner is not None and self.__owners.get((pattern, uidhex), None) is not owner:
+            subscription = None
+        return subscription
+
+    def __route(self, name):
+        # Find the subscribers of a topic and remember them until subscriptions change
+        with self.__lock:
+            route = self.__routes.get(name, None)
+            if route is None:
+                route = []
+                for (pattern, subscribers) in self.__subscriptions.items():
+                    if fnmatch.fnmatchcase(name, pattern):
+                        route.extend(subscribers.values())
+                self.__routes[name] = route
+        return route
+
+    def publish(self, name, envelope):
+        route = self.__route(name)
+        for subscription in route:
+            subscription.put(envelope)
+        return len(route)
+
+
+# Marker used to wake up a worker which is waiting for messages
+WAKEUP = object()
+
+
+class POSQueue(object):
+    '''
+    Bounded queue for the internal bus, when it is full it follows its policy:
+    - block: wait up to 'timeout' seconds for some room, then fail
+    - reject: fail at once
+    - latest: keep only the newest message of each lane (coalesce), the ones
+      thrown away are handed to 'superseded' so their senders can be answered
+    - drop_oldest: drop the oldest message of the lowest lane to make room
+
+    Messages travel in lanes (control, interactive and bulk), higher lanes are
+    served first, but a waiting lane is served anyway once it has been skipped
+    'starvation_limit' times in a row.
+    '''
+
+    POLICIES = ('block', 'reject', 'latest', 'drop_oldest')
+    LANES = ('control', 'interactive', 'bulk')
+    DEFAULT_LANE = 'interactive'
+
+    def __init__(self, maxsize=0, policy='block', timeout=None, starvation_limit=8):
+        if policy not in self.POLICIES:
+            raise POSWorkerConfigError("Queue policy '{}' is unknown, valid policies are: {}".format(policy, ", ".join(self.POLICIES)))
+
+        # Configuration
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.starvation_limit = starvation_limit
+
+        # Counters
+        self.drops = 0
+        self.high_water = 0
+
+        # Internal state
+        self.__lanes = [collections.deque() for lane in self.LANES]
+        self.__skipped = [0 for lane in self.LANES]
+        self.__size = 0
+        self.__puts = 0
+        self.__tails = [0 for lane in self.LANES]   # When the last message of each lane was put
+        self.__woken = False
+        self.__mutex = threading.Lock()
+        self.__not_empty = threading.Condition(self.__mutex)
+        self.__not_full = threading.Condition(self.__mutex)
+
+        # Called (out of the lock) every time something arrives, for consumers not waiting on threads
+        self.notify = None
+        # Called (out of the lock) with the messages thrown away by the 'latest' policy
+        self.superseded = None
+
+    def __full(self):
+        return self.maxsize > 0 and self.__size >= self.maxsize
+
+    def __drop_oldest(self):
+        # Drop from the lowest lane with messages
+        for items in reversed(self.__lanes):
+            if items:
+                items.popleft()
+                self.__size -= 1
+                self.drops += 1
+                break
+
+    def __pop(self):
+        # Choose the highest lane with messages unless a lower one is starving
+        chosen = None
+        for (idx, items) in enumerate(self.__lanes):
+            if items:
+                if chosen is None:
+                    chosen = idx
+                elif self.__skipped[idx] >= self.starvation_limit:
+                    chosen = idx
+                    break
+
+        # Lower lanes waiting have been skipped once more
+        for idx in range(chosen + 1, len(self.__lanes)):
+            if self.__lanes[idx]:
+                self.__skipped[idx] += 1
+        self.__skipped[chosen] = 0
+
+        self.__size -= 1
+        return (self.LANES[chosen], self.__lanes[chosen].popleft())
+
+    def qsize(self):
+        return self.__size
+
+    def full(self):
+        with self.__mutex:
+            return self.__full()
+
+    def put(self, item, block=True, timeout=None, lane=None):
+        if lane is None:
+            lane = self.DEFAULT_LANE
+        try:
+            idx = self.LANES.index(lane)
+            items = self.__lanes[idx]
+        except ValueError:
+            raise POSWorkerConfigError("Lane '{}' is unknown, valid lanes are: {}".format(lane, ", ".join(self.LANES)))
+
+        superseded = None
+        with self.__mutex:
+            if self.policy == 'latest':
+                # Coalesce, only the newest message matters
+                if items:
+                    superseded = list(items)
+                    self.drops += len(items)
+                    self.__size -= len(items)
+                    items.clear()
+            elif self.__full():
+                if self.policy == 'drop_oldest':
+                    self.__drop_oldest()
+                elif self.policy == 'reject' or not block:
+                    self.drops += 1
+                    raise POSQueueFull("Queue is full ({} messages waiting)".format(self.__size))
+                else:
+                    if timeout is None:
+                        timeout = self.timeout
+                    if not self.__not_full.wait_for(lambda: not self.__full(), timeout):
+                        self.drops += 1
+                        raise POSQueueFull("Queue is still full after {} seconds ({} messages waiting)".format(timeout, self.__size))
+
+            # Queue the message
+            items.append(item)
+            self.__size += 1
+            self.__puts += 1
+            self.__tails[idx] = self.__puts
+            self.high_water = max(self.high_water, self.__size)
+            self.__not_empty.notify()
+
+        if superseded and self.superseded:
+            self.superseded(superseded)
+        if self.notify:
+            self.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.__mutex:
+            if block and not self.__size:
+                self.__not_empty.wait_for(lambda: self.__size or self.__woken, timeout)
+
+            if self.__size:
+                (lane, item) = self.__pop()
+                self.__not_full.notify()
+            elif self.__woken:
+                self.__woken = False
+                item = WAKEUP
+            else:
+                raise queue.Empty()
+
+        return item
+
+    def get_many(self, max_items=None, block=True, timeout=None, lanes=False):
+        # Take a burst of messages under a single lock, WAKEUP alone if we were woken up
+        # (with lanes every message comes as (lane, message) and WAKEUP as (None, WAKEUP))
+        with self.__mutex:
+            if block and not self.__size:
+                self.__not_empty.wait_for(lambda: self.__size or self.__woken, timeout)
+
+            items = []
+            while self.__size and (max_items is None or len(items) < max_items):
+                if lanes:
+                    items.append(self.__pop())
+                else:
+                    items.append(self.__pop()[1])
+
+            if items:
+                self.__not_full.notify(len(items))
+            elif self.__woken:
+                self.__woken = False
+                if lanes:
+                    items.append((None, WAKEUP))
+                else:
+                    items.append(WAKEUP)
+
+        return items
+
+    def get_latest(self, block=True, timeout=None):
+        # Take the newest message and throw away everything else
+        with self.__mutex:
+            if block and not self.__size:
+                self.__not_empty.wait_for(lambda: self.__size, timeout)
+
+            if self.__size:
+                # The newest message is at the end of the lane which got something last
+                newest = max((idx for (idx, items) in enumerate(self.__lanes) if items), key=lambda idx: self.__tails[idx])
+                item = self.__lanes[newest].pop()
+                superseded = []
+                for items in self.__lanes:
+                    superseded.extend(items)
+                    items.clear()
+                self.__size = 0
+                self.__not_full.notify_all()
+            else:
+                raise queue.Empty()
+
+        if superseded and self.superseded:
+            self.superseded(superseded)
+        return item
+
+    def wakeup(self):
+        with self.__mutex:
+            self.__woken = True
+            self.__not_empty.notify_all()
+
+        if self.notify:
+            self.notify()
+
+    def stats(self):
+        return {
+            'depth': self.__size,
+            'lanes': dict(zip(self.LANES, [len(items) for items in self.__lanes])),
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'drops': self.drops,
+            'high_water': self.high_water,
+        }
+
+
 class POSWorker(threading.Thread, Debugger):
-    queues = {}
-    channels = {}
+    registry = POSWorkerRegistry()
+    channels = POSChannels()
     module_name = None
     slow_loop = True
+    loop_tick = 1              # Seconds between loop() calls when slow_loop is set (config key 'tick')
+    loop_pace = 0.05           # Shortest pass when slow_loop is not set and loop() doesn't block by itself
+    defensive_copy = False     # Send a deep copy of every message instead of the message itself
+    queue_size = 100           # Messages our queue can hold (config key 'queue_size')
+    queue_policy = 'block'     # What to do when our queue is full (see POSQueue)
+    queue_timeout = 5          # Seconds a sender may wait when our queue is full and policy is 'block'
+    priority = 'interactive'   # Lane used for the messages we send (see POSQueue.LANES)
+    batch_size = 16            # Messages taken from our queue at once by run()
+    durable = True             # Messages we send wait in the outbox until they reach the server
 
     def __init__(self, uid, config):
         # Get hex uuid
@@ -52,15 +446,16 @@ class POSWorker(threading.Thread, Debugger):
         self.__config = config
         self.__uuid = uid
         self.__uuidhex = uidhex
-        self.__queue = queue.Queue()
+        self.__queue = POSQueue(self.config('queue_size', self.queue_size), self.queue_policy, self.queue_timeout)
         self.__parent = None
+        self.__awake = False
 
-        # Attach our queue to the Queue system
-        self.queues[uidhex] = self.__queue
+        # Answer the requests our queue coalesces (the queue must not keep us alive)
+        superseded = weakref.WeakMethod(self.superseded)
+        self.__queue.superseded = lambda envelopes: superseded() is not None and superseded()(envelopes)
 
-    def __del__(self):
-        if self.__uuidhex in self.queues:
-            self.queues.pop(self.__uuidhex)
+        # Attach our queue to the Queue system
+        self.registry.register(uidhex, self.__queue, self)
 
     @property
     def uuid(self):
@@ -70,74 +465,98 @@ class POSWorker(threading.Thread, Debugger):
     def uuidhex(self):
         return self.__uuidhex
 
+    @property
+    def parentuuid(self):
+        return self.__parent
+
+    @property
+    def mailbox(self):
+        # Our own queue (the registry may point somewhere else if we got replaced)
+        return self.__queue
+
     def add_channel(self, name):
-        if name not in self.channels:
-            self.channels[name] = queue.Queue()
-        else:
+        if not self.channels.add(name):
             self.warning("I have tried to add an already existing channel named '{}'".format(name))
 
     def remove_channel(self, name):
-        if name in self.channels:
-            self.channels.pop(name)
-        else:
+        if not self.channels.remove(name):
             self.warning("I have tried to remove a non-existing channel named '{}'".format(name))
 
+    def subscribe(self, pattern, size=None):
+        # Subscribe to every channel matching the pattern (wildcards allowed: 'weight.*')
+        if size is None:
+            size = self.queue_size
+        subscription = self.channels.subscribe(self.__uuidhex, pattern, size, self.__queue)
+        if subscription is None:
+            self.warning("I have tried to subscribe twice to '{}'".format(pattern))
+        else:
+            # Unsubscribe automatically once we are gone (unless somebody took our place)
+            weakref.finalize(self, self.channels.unsubscribe, self.__uuidhex, pattern, subscription)
+
+    def unsubscribe(self, pattern):
+        subscription = self.channels.subscription(self.__uuidhex, pattern, self.__queue)
+        if subscription is None or not self.channels.unsubscribe(self.__uuidhex, pattern, subscription):
+            self.warning("I have tried to unsubscribe from '{}' but I was not subscribed".format(pattern))
+
     def size_channel(self, name):
-        # Locate the channel
-        channel = self.channels.get(name, None)
+        # Locate our subscription
+        subscription = self.channels.subscription(self.__uuidhex, name, self.__queue)
 
-        if channel:
+        if subscription:
 
-            size = channel.qsize()
+            size = subscription.qsize()
 
         else:
-            self.warning("I have get the size of a non-existing channel named '{}'".format(name))
+            self.warning("I have get the size of a non-subscribed channel named '{}'".format(name))
             size = None
 
         # Return answer
         return size
 
-    def sendto_channel(self, name, msg):
+    def publish(self, name, msg):
+        # Deliver the same envelope to every subscriber, return how many got it
+        return self.channels.publish(name, self.envelope(msg, None))
 
-        # Locate the channel
-        channel = self.channels.get(name, None)
+    def sendto_channel(self, name, msg):
 
-        if channel:
+        # Check the channel
+        exists = self.channels.exists(name)
 
-            # Convert message to JSON
-            tmsg = json.dumps((self.__uuidhex, msg))
+        if exists:
 
             # Send the message
-            channel.put(tmsg)
+            self.publish(name, msg)
 
         else:
             self.warning("I have tried to send to a non-existing channel named '{}'".format(name))
 
         # Return answer
-        return (channel is not None)
+        return exists
 
     def getfrom_channel(self, name, block=False, timeout=None):
 
-        # Locate the channel
-        channel = self.channels.get(name, None)
+        # Locate our subscription
+        subscription = self.channels.subscription(self.__uuidhex, name, self.__queue)
 
-        if channel:
+        if subscription:
 
             # Get message
             try:
-                tmsg = channel.get(block, timeout)
+                envelope = subscription.get(block, timeout)
             except queue.Empty:
-                tmsg = None
+                envelope = None
 
-            if tmsg:
+            if envelope:
 
-                # Decode message
-                (uid, msg) = json.loads(tmsg)
+                # Open the envelope
+                uid = envelope.uid
+                msg = envelope.msg
 
                 # Look for the target queue
-                if uid in self.queues:
+                source = self.registry.get_queue(uid)
+                if source is not None:
                     # Give back the queue object already selected
-                    answer = (self.queues[uid], msg)
+                    answer = (source, msg)
                 else:
                     # Unknown sender detected (or Queue not registered properly)
                     self.warning("We got a message from an unknown Queue with UUID '{}' (maybe it didn't register properly)".format(uid))
@@ -147,7 +566,7 @@ class POSWorker(threading.Thread, Debugger):
                 answer = None
 
         else:
-            self.warning("Tried to get from a non-existing channel named '{}'".format(name))
+            self.warning("Tried to get from a non-subscribed channel named '{}'".format(name))
             answer = None
 
         # Return answer
@@ -155,8 +574,8 @@ class POSWorker(threading.Thread, Debugger):
 
     def parent(self, uidhex, queue):
         self.__parent = uidhex
-        if uidhex not in self.queues:
-            self.queues[uidhex] = queue
+        if uidhex not in self.registry:
+            self.registry.register(uidhex, queue)
 
     def config(self, key, default=None, mandatory=False):
         if type(self.__config) is dict and key in self.__config:
@@ -170,18 +589,15 @@ class POSWorker(threading.Thread, Debugger):
     def get_queue(self, uid):
         if isinstance(uid, uuid.UUID):
             uid = uid.hex
-        return self.queues.get(uid, None)
+        return self.registry.get_queue(uid)
 
     def get_uuid(self, obj):
         # Check if we got a Queue
         uid = None
-        if isinstance(obj, queue.Queue):
+        if isinstance(obj, POSQueue):
 
             # Get got a Queue, find its UUID
-            result = None
-            for tuuid, tqueue in self.queues.items():
-                if tqueue == obj:
-                    result = tuuid
+            result = self.registry.get_uuid(obj)
 
             # If we got the UUID
             if result:
@@ -197,50 +613,124 @@ class POSWorker(threading.Thread, Debugger):
 
         # Get message
         try:
-            tmsg = self.__queue.get(block, timeout)
+            envelope = self.__queue.get(block, timeout)
         except queue.Empty:
-            tmsg = None
+            envelope = None
+
+        # Somebody asked us to wake up, there is no message to work on
+        if envelope is WAKEUP:
+            self.__awake = True
+            envelope = None
 
         # If got a message
-        if tmsg:
-            # Decode message
-            (uid, msg, ref) = json.loads(tmsg)
+        if envelope:
+            answer = self.__open(envelope)
+        else:
+            answer = None
 
-            # Look for the target queue
-            if uid in self.queues:
-                # Give back the queue object already selected
-                answer = (self.queues[uid], msg, ref)
-            else:
-                # Unknown sender detected (or Queue not registered properly)
-                self.warning("We got a message from an unknown Queue with UUID '{}' (maybe it didn't register properly)".format(uid))
-                answer = (uid, msg, ref)
+        return answer
+
+    def get_many(self, max_items=None, timeout=None):
 
+        # Get a burst of messages (wait for the first one until timeout)
+        envelopes = self.__queue.get_many(max_items, bool(timeout), timeout)
+
+        # Somebody asked us to wake up, there is no message to work on
+        if envelopes and envelopes[0] is WAKEUP:
+            self.__awake = True
+            envelopes = []
+
+        # Open them while the caller walks through them
+        return (self.__open(envelope) for envelope in envelopes)
+
+    def get_latest(self, block=False, timeout=None):
+
+        # Get the newest message, the rest are skipped without opening them
+        try:
+            envelope = self.__queue.get_latest(block, timeout)
+        except queue.Empty:
+            envelope = None
+
+        # If got a message
+        if envelope:
+            answer = self.__open(envelope)
         else:
             answer = None
 
         return answer
 
-    def send(self, msg, ref, target=None):
+    def __open(self, envelope):
+
+        # Open the envelope
+        uid = envelope.uid
+        msg = envelope.msg
+        ref = envelope.ref
+
+        # Look for the target queue
+        source = self.registry.get_queue(uid)
+        if source is not None:
+            # Give back the queue object already selected
+            answer = (source, msg, ref)
+        else:
+            # Unknown sender detected (or Queue not registered properly)
+            self.warning("We got a message from an unknown Queue with UUID '{}' (maybe it didn't register properly)".format(uid))
+            answer = (uid, msg, ref)
+
+        return answer
+
+    def send(self, msg, ref, target=None, priority=None, block=True):
 
         # Autoselect parent
         if target is None:
             target = self.get_queue(self.__parent)
 
         # Check if we got a Queue
-        if not isinstance(target, queue.Queue):
+        if not isinstance(target, POSQueue):
 
             # Look for the target queue
-            if target in self.queues:
-                target = self.queues[target]
+            queue_target = self.registry.get_queue(target)
+            if queue_target is not None:
+                target = queue_target
             else:
                 # Notify if no queue found
                 raise POSWorkerNotFound("POSWorker with UUID '{}' didn't register properly (Queue messages not found)".format(target))
 
-        # Convert message to JSON
-        msg = json.dumps((self.__uuidhex, msg, ref))
+        # Send the message to the queue using our lane unless we were told otherwise
+        if priority is None:
+            priority = self.priority
+        target.put(self.envelope(msg, ref), block, lane=priority)
+
+    def superseded(self, envelopes):
+        # Requests coalesced by our queue will never be served, let their senders know
+        for envelope in envelopes:
+            if envelope.ref is not None:
+                try:
+                    self.send({'uuid': self.uuidhex, 'from': envelope.uid, 'msg': envelope.msg, 'error': "Superseded by a newer request"}, envelope.ref, envelope.uid, block=False)
+                except (POSQueueFull, POSWorkerNotFound) as e:
+                    self.warning("Couldn't tell {} its request was superseded: {}".format(envelope.uid, e))
+
+    def envelope(self, msg, ref):
+        # Messages are passed by reference unless we were asked to protect them
+        if self.defensive_copy:
+            msg = copy.deepcopy(msg)
+        return Envelope(self.__uuidhex, msg, ref)
+
+    def queue_stats(self):
+        return self.__queue.stats()
+
+    @property
+    def awake(self):
+        return self.__awake
 
-        # Send the message to the queue
-        target.put(msg)
+    def woken(self):
+        # Tell if somebody asked us to wake up and forget about it
+        awake = self.__awake
+        self.__awake = False
+        return awake
+
+    def wakeup(self):
+        # Wake up the worker so it runs loop() right now (useful when the device has something ready for us)
+        self.__queue.wakeup()
 
     def loop(self):
         pass
@@ -249,26 +739,40 @@ class POSWorker(threading.Thread, Debugger):
         if self.module_name:
             self.debug("Starting {}".format(self.module_name), color='blue')
 
+        # Time between loops and when the next one should happen (fast loopers
+        # call loop() on every pass, they only wait when loop() didn't block)
+        if self.slow_loop:
+            tick = self.config('tick', self.loop_tick)
+        else:
+            tick = self.loop_pace
+        next_loop = time.monotonic()
+
         # Keep running until master say to stop
         while not self.stoprequest.isSet():
 
+            # Wait for messages until next loop is due
+            wait = max(0, next_loop - time.monotonic())
+
             # Check if we have messages waiting
-            package = self.get()
-            if package:
-                (source, msg, ref) = package
+            got = False
+            for (source, msg, ref) in self.get_many(self.batch_size, wait):
+                got = True
                 try:
                     self.recv(msg, ref, source)
                 except Exception as e:
                     try:
-                        self.send({'uuid': self.uuidhex, 'from': self.get_uuid(source), 'msg': msg, 'error': e}, ref)
+                        self.send({'uuid': self.uuidhex, 'from': self.get_uuid(source), 'msg': msg, 'error': str(e)}, ref)
+                    except POSQueueFull as e:
+                        self.error("Error answer couldn't be delivered: {}".format(e))
                     except Exception as e:
                         self.send({'uuid': self.uuidhex, 'from': self.get_uuid(source), 'msg': msg, 'error': "ERROR can not be sent: {}".format(e)}, ref)
-            else:
+
+            if not got:
                 if getattr(self, 'demo', None):
                     # Demo mode is on
                     if random.randint(0, 100) > 90:
                         # Choose a random queue
-                        qs = list(self.queues.keys())
+                        qs = self.registry.uuids()
                         qs.pop(qs.index(self.uuidhex))
                         targetuuid = random.choice(qs)
                         # Send message
@@ -279,11 +783,19 @@ class POSWorker(threading.Thread, Debugger):
                         self.send(msg, None, targetuuid)
                     else:
                         time.sleep(0.1)
-                else:
-                    # Do a loop and wait sec
+                    continue
+
+            if self.woken() or not self.slow_loop or time.monotonic() >= next_loop:
+                # Do a loop and schedule the next one
+                started = time.monotonic()
+                try:
                     self.loop()
-                    if self.slow_loop:
-                        time.sleep(1)
+                except POSQueueFull as e:
+                    self.warning("Message from loop couldn't be delivered: {}".format(e))
+                if self.slow_loop:
+                    next_loop = time.monotonic() + tick
+                else:
+                    next_loop = started + tick
 
     def recv(self, msg, ref, uid=None):
         # Autoselect parent
@@ -293,7 +805,7 @@ class POSWorker(threading.Thread, Debugger):
         if 'error' in msg:
             self.debug("{} GOT ANSWER FROM {} -> ERROR - [{}] (ref:{})".format(self.uuid, self.get_uuid(uid), msg.get('error', 'No error'), ref), color='green')
         elif uid is not None and 'ping' in msg:
-            self.send("pong", ref, uid)
+            self.send("pong", ref, uid, 'control')
         elif 'ack' in msg:
             self.debug("{} GOT ANSWER FROM {} -> ACK - [{}] (ref:{})".format(self.uuid, self.get_uuid(uid), msg.get('ack', False), ref), color='green')
         elif 'message' in msg:
@@ -307,8 +819,17 @@ class POSWorker(threading.Thread, Debugger):
             self.debug(msg)
             self.send({'error': msg}, ref, uid)
 
-    def join(self, timeout=None):
+    def crashed(self):
+        # We were started and we are gone without being asked to stop
+        return self.ident is not None and not self.is_alive() and not self.stoprequest.isSet()
+
+    def stop(self):
+        # Ask the worker to finish without waiting for it
         self.stoprequest.set()
+        self.wakeup()
+
+    def join(self, timeout=None):
+        self.stop()
         super(POSWorker, self).join(timeout)
 
 
@@ -328,3 +849,57 @@ class POSWorkerNotFound(Exception):
 
     def __str__(self):
         return self.string
+
+
+class POSQueueFull(Exception):
+
+    def __init__(self, string):
+        self.string = string
+
+    def __str__(self):
+        return self.string
+
+
+if __name__ == '__main__':
+    # Messages/sec between two threads: JSON text as the bus used to carry against envelopes
+    import json
+    import base64
+
+    messages = {
+        'ping': {'ping': True},
+        'ticket': {
+            'ctx': {
+                'logo': base64.b64encode(bytes(range(256)) * 64).decode('utf-8'),
+                'lines': [{'product': "Product {}".format(i), 'quantity': i % 3 + 1, 'price': 1.35 * i} for i in range(40)],
+                'total': 1234.56,
+            },
+            'template': 'ticket',
+        },
+    }
+    modes = {
+        'json': (lambda uid, msg, ref: json.dumps((uid, msg, ref)), lambda item: json.loads(item)),
+        'envelope': (lambda uid, msg, ref: Envelope(uid, msg, ref), lambda item: (item.uid, item.msg, item.ref)),
+        'copy': (lambda uid, msg, ref: Envelope(uid, copy.deepcopy(msg), ref), lambda item: (item.uid, item.msg, item.ref)),
+    }
+    rounds = 20000
+    uidhex = uuid.uuid4().hex
+
+    for (kind, msg) in messages.items():
+        for (mode, (pack, unpack)) in modes.items():
+            bus = POSQueue(1000)
+
+            def consumer():
+                left = rounds
+                while left:
+                    for item in bus.get_many(None, True, 1):
+                        unpack(item)
+                        left -= 1
+
+            thread = threading.Thread(target=consumer)
+            start = time.perf_counter()
+            thread.start()
+            for ref in range(rounds):
+                bus.put(pack(uidhex, msg, ref))
+            thread.join()
+            elapsed = time.perf_counter() - start
+            print("{:>6} {:>8}: {:10.0f} messages/sec".format(kind, mode, rounds / elapsed))
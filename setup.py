@@ -15,6 +15,7 @@ setup(
     scripts=['codenerix_pos_client/posclient.py'],
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.8',
     license='Apache License Version 2.0',
     description='Codenerix POS Client enables the system to work with codenerix_pos_client command line tool so it can connecto to CODENERIX POS server.',
     long_description=README,
@@ -28,7 +29,7 @@ setup(
         'License :: Other/Proprietary License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],